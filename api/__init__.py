@@ -1,6 +1,9 @@
-from flask import Blueprint, g, jsonify, request
+from flask import Blueprint, current_app, g, jsonify, redirect, request, \
+    Response, send_file
 from functools import wraps
-from mongoframes import *
+import os
+from urllib.parse import quote
+from werkzeug.http import http_date, is_resource_modified
 
 from models.accounts import Account
 
@@ -15,6 +18,7 @@ __all__ = [
 
     # Responses
     'fail',
+    'file_response',
     'success'
     ]
 
@@ -35,7 +39,7 @@ def authenticated(func):
             return fail('`api_key` not specified.')
 
         # Find the account
-        account = Account.one(Q.api_key == api_key.strip())
+        account = Account.by_api_key(api_key.strip())
         if not account:
             return fail('Not a valid `api_key`.')
 
@@ -56,6 +60,192 @@ def fail(reason, issues=None):
         response['payload']['issues'] = issues
     return jsonify(response)
 
+def file_response(
+    backend,
+    key,
+    content_type,
+    length=None,
+    filename=None,
+    last_modified=None,
+    etag=None,
+    max_age=None
+    ):
+    """
+    Return a response that serves a file from a backend. If a filename is given
+    the file is served as an attachment.
+
+    Files held on the local file system can be handed off to nginx or the WSGI
+    server (see `DOWNLOAD_MODE`) so that the file's contents never pass through
+    the application, all other files are streamed from the backend.
+
+    If the file's length is given then requests for a single range of bytes
+    (`Range`) are supported, only the requested bytes are read from the
+    backend.
+
+    If an ETag and/or last modified date is given then conditional requests
+    (`If-None-Match`, `If-Modified-Since`) for a file the client already has
+    are answered (304) without accessing the backend.
+
+    Backends that can provide a (short-lived) URL for the file to be downloaded
+    from directly (see `Backend.get_download_url`) are redirected to, so the
+    file's contents never pass through the application.
+    """
+    mode = current_app.config['DOWNLOAD_MODE']
+    local_path = backend.get_local_path(key)
+
+    # Files can only be handed off to nginx if they're held within the
+    # directory nginx serves them from, other files are streamed.
+    accel_path = None
+    if mode == 'accel':
+        if local_path:
+            accel_path = get_accel_path(local_path)
+        if not accel_path:
+            mode = 'stream'
+
+    # Check if the client already has the file
+    modified = True
+    if etag or last_modified:
+        modified = is_resource_modified(
+            request.environ,
+            etag=etag,
+            last_modified=last_modified
+            )
+
+    # Check if a range of the file has been requested
+    byte_range = None
+    if modified and length is not None and mode != 'accel':
+        byte_range = get_byte_range(length, last_modified, etag)
+
+    # Check if the file can be downloaded directly from the backend
+    download_url = None
+    if modified:
+        download_url = backend.get_download_url(key, content_type, filename)
+
+    if download_url:
+        # Redirect the client to the backend, the URL expires so the redirect
+        # mustn't be cached.
+        response = redirect(download_url)
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+
+    if not modified:
+        # The client's copy of the file is up to date
+        response = Response(status=304)
+
+    elif byte_range == 'unsatisfiable':
+        # The range requested isn't within the file
+        response = Response(status=416)
+        response.headers['Content-Range'] = 'bytes */{0}'.format(length)
+
+    elif byte_range:
+        # Stream the range of the file from the backend
+        start, stop = byte_range
+        response = Response(
+            backend.stream_range(key, start, stop - 1),
+            status=206,
+            direct_passthrough=True
+            )
+        response.headers['Content-Length'] = stop - start
+        response.headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(
+            start,
+            stop - 1,
+            length
+            )
+
+    elif accel_path:
+        # Let nginx serve the file
+        response = Response()
+        response.headers['X-Accel-Redirect'] = quote(accel_path)
+
+    elif local_path and mode == 'sendfile':
+        # Let the WSGI server serve the file
+        response = send_file(local_path, add_etags=False)
+
+    else:
+        # Stream the file from the backend so that the file is never held in
+        # memory in full.
+        response = Response(backend.stream(key), direct_passthrough=True)
+
+        # Set the content length if we know it, otherwise the response will be
+        # sent chunked.
+        if length is not None:
+            response.headers['Content-Length'] = length
+
+    # Let the client know ranges are supported (nginx handles ranges itself)
+    if length is not None and mode != 'accel':
+        response.headers['Accept-Ranges'] = 'bytes'
+
+    # Add validators and caching rules for the file
+    if etag:
+        response.set_etag(etag)
+
+    if last_modified:
+        response.last_modified = last_modified
+
+    if max_age is not None:
+        response.headers['Cache-Control'] = \
+                'max-age={0}, public'.format(max_age)
+
+    if response.status_code == 304:
+        return response
+
+    response.headers['Content-Type'] = content_type
+    if filename:
+        response.headers['Content-Disposition'] = \
+            'attachment; filename={0}'.format(filename)
+
+    return response
+
+def get_accel_path(local_path):
+    """
+    Return the path nginx serves a file on the local file system from (see
+    `DOWNLOAD_ACCEL_PREFIX` and `DOWNLOAD_ACCEL_ROOT`), or `None` if the file
+    isn't held within the `DOWNLOAD_ACCEL_ROOT` directory.
+    """
+    root = current_app.config['DOWNLOAD_ACCEL_ROOT']
+    if not root:
+        return
+
+    root = os.path.abspath(root)
+    local_path = os.path.abspath(local_path)
+    if not local_path.startswith(root + os.sep):
+        return
+
+    return '/'.join([
+        current_app.config['DOWNLOAD_ACCEL_PREFIX'].rstrip('/'),
+        os.path.relpath(local_path, root).replace(os.sep, '/')
+        ])
+
+def get_byte_range(length, last_modified=None, etag=None):
+    """
+    Return the range of bytes (start, stop) requested for a file of the given
+    length, `None` if the full file should be sent or 'unsatisfiable' if the
+    requested range isn't within the file.
+
+    Only single ranges are supported, if an `If-Range` ETag or date is given
+    that doesn't match the file's ETag or last modified date the full file is
+    sent.
+    """
+    byte_range = request.range
+    if not byte_range or byte_range.units != 'bytes' \
+            or len(byte_range.ranges) != 1:
+        return
+
+    # Check the file hasn't changed since the client requested it
+    if_range = request.headers.get('If-Range')
+    if if_range:
+        if request.if_range.etag is not None:
+            if request.if_range.etag != etag:
+                return
+
+        elif not last_modified or request.if_range.date is None:
+            return
+
+        elif http_date(request.if_range.date) != http_date(last_modified):
+            return
+
+    return byte_range.range_for_length(length) or 'unsatisfiable'
+
 def success(payload=None):
     """Return a success response"""
     response = {'status': 'success'}
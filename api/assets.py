@@ -6,22 +6,37 @@ import mimetypes
 import re
 import time
 
-from flask import current_app, g, make_response, request
+from flask import current_app, g, request, url_for
 from mongoframes import *
 import os
 from PIL import Image
 from PIL.ExifTags import TAGS
+from pymongo.errors import DuplicateKeyError
 from slugify import Slugify
 
 from api import *
 from forms.assets import *
 from models.assets import Asset, Variation
-from utils import get_file_length, generate_uid
+from models.blobs import Blob
+from models.uploads import Upload
+from utils import get_file_hash, get_file_length, generate_uid, jpeg
+from utils.faces import FaceDetectionPoolBusy
 
 # Fix for missing mimetypes
 mimetypes.add_type('text/csv', '.csv')
 mimetypes.add_type('image/webp', '.webp')
 
+# The transposes required to orient an image for each EXIF orientation value
+ORIENTATION_TRANSPOSES = {
+    2: [Image.FLIP_LEFT_RIGHT],
+    3: [Image.ROTATE_180],
+    4: [Image.FLIP_TOP_BOTTOM],
+    5: [Image.FLIP_LEFT_RIGHT, Image.ROTATE_90],
+    6: [Image.ROTATE_270],
+    7: [Image.FLIP_TOP_BOTTOM, Image.ROTATE_90],
+    8: [Image.ROTATE_90]
+    }
+
 
 # Routes
 
@@ -34,25 +49,34 @@ def download():
     form = DownloadForm(request.values)
     if not form.validate():
         return fail('Invalid request', issues=form.errors)
-    form_data = form.data
 
-    # Get the asset
-    asset = Asset.one(And(
-        Q.account == g.account,
-        Q.uid == form_data['uid']
-        ))
+    # Get the asset (loaded when the form was validated)
+    asset = form.asset
 
-    # Retrieve the original file
-    backend = g.account.get_backend_instance()
-    f = backend.retrieve(asset.store_key)
+    # Files uploaded directly to the backend can't be downloaded until they've
+    # been prepared (see `upload_complete`).
+    if (asset.meta or {}).get('pending'):
+        return fail('Asset is being prepared, please try again later.')
 
-    # Build the file response to return
-    response = make_response(f.read())
-    response.headers['Content-Type'] = asset.content_type
-    response.headers['Content-Disposition'] = \
-        'attachment; filename={0}'.format(asset.store_key)
+    # Allow the file to be cached for up to the maximum age (or until the
+    # asset expires).
+    max_age = current_app.config['DOWNLOAD_CACHE_MAX_AGE']
+    if asset.expires:
+        now = time.mktime(datetime.now(timezone.utc).timetuple())
+        max_age = max(0, min(max_age, int(asset.expires - now)))
 
-    return response
+    # Serve the original file
+    backend = g.account.get_backend_instance()
+    return file_response(
+        backend,
+        asset.backend_key,
+        asset.content_type,
+        length=(asset.meta or {}).get('length'),
+        filename=asset.store_key,
+        last_modified=asset.modified,
+        etag=asset.etag,
+        max_age=max_age
+        )
 
 @api.route('/get')
 @authenticated
@@ -63,15 +87,38 @@ def get():
     form = GetForm(request.values)
     if not form.validate():
         return fail('Invalid request', issues=form.errors)
-    form_data = form.data
 
-    # Get the asset
-    asset = Asset.one(And(
-        Q.account == g.account,
-        Q.uid == form_data['uid']
-        ))
+    # Get the asset (loaded when the form was validated)
+    asset = form.asset
 
-    return success(asset.to_json_type())
+    # If the asset can be downloaded directly from the backend include the
+    # (short-lived) URL, the payload then changes with every request so it's
+    # never cached.
+    payload = asset.to_json_type()
+    url = None
+    if not (asset.meta or {}).get('pending'):
+        backend = g.account.get_backend_instance()
+        url = backend.get_download_url(
+            asset.backend_key,
+            asset.content_type,
+            asset.store_key
+            )
+
+    if url:
+        payload['url'] = url
+        response = success(payload)
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+
+    # Tag the response so that clients can check if the asset has changed
+    # since they last requested it.
+    response = success(payload)
+    response.add_etag()
+    response.headers['Cache-Control'] = 'no-cache'
+    if asset.modified:
+        response.last_modified = asset.modified
+
+    return response.make_conditional(request)
 
 @api.route('/', endpoint='list')
 @authenticated
@@ -148,8 +195,8 @@ def generate_variations():
         return fail('Invalid request', issues=form.errors)
     form_data = form.data
 
-    # Find the asset
-    asset = Asset.one(And(Q.account == g.account, Q.uid == form_data['uid']))
+    # Get the asset (loaded when the form was validated)
+    asset = form.asset
 
     # Check the asset is an image
     if asset.type != 'image':
@@ -163,16 +210,35 @@ def generate_variations():
     if on_delivery == 'wait':
         # Caller is waiting for a response so generate the variations now
 
+        # If the variations already exist (with the same names and ops) there's
+        # nothing to generate.
+        if not form_data['force']:
+            new_variations = asset.find_variations(variations)
+            if len(new_variations) == len(variations):
+                return success({
+                    name: variation.to_json_type()
+                    for name, variation in new_variations.items()
+                    })
+
         # Retrieve the original file
         backend = g.account.get_backend_instance()
-        f = backend.retrieve(asset.store_key)
+        f = backend.retrieve(asset.backend_key)
         im = Image.open(f)
 
         # Generate the variations
-        new_variations = {}
-        for name, ops in variations.items():
-            new_variations[name] = asset.add_variation(f, im, name, ops)
-            new_variations[name] = new_variations[name].to_json_type()
+        try:
+            new_variations = asset.add_variations(
+                f,
+                im,
+                variations,
+                form_data['force']
+                )
+        except FaceDetectionPoolBusy:
+            return fail('Face detection is busy, please try again later.')
+        new_variations = {
+            name: variation.to_json_type()
+            for name, variation in new_variations.items()
+            }
 
         # Update the assets modified timestamp
         asset.update('modified')
@@ -184,7 +250,13 @@ def generate_variations():
         # in the background.
         current_app.celery.send_task(
             'generate_variations',
-            [g.account._id, asset.uid, variations, form_data['webhook'].strip()]
+            [
+                g.account._id,
+                asset.uid,
+                variations,
+                form_data['webhook'].strip(),
+                form_data['force']
+            ]
             )
 
         return success()
@@ -200,11 +272,8 @@ def set_expires():
         return fail('Invalid request', issues=form.errors)
     form_data = form.data
 
-    # Get the asset
-    asset = Asset.one(And(
-        Q.account == g.account,
-        Q.uid == form_data['uid']
-        ))
+    # Get the asset (loaded when the form was validated)
+    asset = form.asset
 
     # Update the assets `expires` value
     if 'expires' in form_data:
@@ -253,7 +322,8 @@ def upload():
     # the imghdr module
     if not ext:
         fs.stream.seek(0)
-        ext = imghdr.what(fs.filename,fs.stream.read()) or ''
+        ext = imghdr.what(fs.filename, fs.stream.read(32)) or ''
+        fs.stream.seek(0)
 
     # If the file is a recognized image format then attempt to read it as an
     # image otherwise leave it as a file.
@@ -266,9 +336,11 @@ def upload():
         except IOError as e:
             return fail('File appears to be an image but it cannot be read.')
 
-    # Add basic file information to the asset meta
+    # Add basic file information to the asset meta (the hash of the file's
+    # contents is used to identify the file, e.g as an ETag).
     asset_meta.update({
         'filename': fs.filename,
+        'hash': get_file_hash(asset_file),
         'length': get_file_length(asset_file)
         })
 
@@ -286,31 +358,328 @@ def upload():
         asset.expires = form_data['expires']
 
     # Generate a unique Id for the asset
-    asset.uid = generate_uid(6)
-    while Asset.count(And(Q.account == g.account, Q.uid == asset.uid)) > 0:
-        asset.uid = generate_uid(6)
+    asset.uid = generate_asset_uid(g.account)
+
+    # Detect faces in images on upload (if configured)
+    detect_faces = ''
+    if asset_type == 'image' and current_app.config['SUPPORT_FACE_DETECTION']:
+        detect_faces = current_app.config['FACE_DETECTION_ON_UPLOAD']
 
-    # Store the original file
+    if detect_faces == 'wait':
+        try:
+            asset.detect_faces(Image.open(asset_file))
+        except FaceDetectionPoolBusy:
+            return fail('Face detection is busy, please try again later.')
+        asset_file.seek(0)
+
+    # Store the original file, deduplicated files are stored as blobs shared
+    # by all of the account's assets with the same content.
     asset.store_key = Asset.get_store_key(asset)
-    backend = g.account.get_backend_instance()
-    backend.store(asset_file, asset.store_key)
+    if current_app.config['DEDUPLICATE_ASSETS']:
+        blob = Blob.store(g.account, asset.meta['hash'], asset_file, ext)
+        asset.blob_key = blob.store_key
+
+    else:
+        backend = g.account.get_backend_instance()
+        backend.store(asset_file, asset.store_key)
 
     # Save the asset
     asset.insert()
 
+    if detect_faces == 'background':
+        current_app.celery.send_task(
+            'detect_faces',
+            [g.account._id, asset.uid]
+            )
+
     return success(asset.to_json_type())
 
+@api.route('/upload-complete', methods=['POST'])
+@authenticated
+def upload_complete():
+    """
+    Complete an upload made directly to the account's backend (see
+    `upload_reserve`) creating the asset.
+
+    Images are prepared (oriented and stripped of meta data) before the asset
+    is created so variations and downloads are never made from the unprepared
+    file. Other files are hashed in the background and can't be downloaded
+    until they have been (see the `prep_asset` task).
+    """
+
+    # Validate the parameters
+    form = UploadCompleteForm(request.values)
+    if not form.validate():
+        return fail('Invalid request', issues=form.errors)
+
+    # Get the upload (loaded when the form was validated)
+    upload = form.upload
+
+    # Check the file has been uploaded
+    backend = g.account.get_backend_instance()
+    length = backend.get_length(upload.store_key)
+    if length is None:
+        return fail('No file has been uploaded.')
+
+    # Create the asset
+    asset = Asset(
+        account=g.account._id,
+        uid=upload.uid,
+        name=upload.name,
+        ext=upload.ext,
+        meta={'filename': upload.filename, 'length': length},
+        type=Asset.get_type(upload.ext),
+        store_key=upload.store_key,
+        variations=[]
+        )
+
+    if upload.asset_expires:
+        asset.expires = upload.asset_expires
+
+    if asset.type == 'image':
+        # Prepare the image, replacing the uploaded file if it's changed
+        f = backend.retrieve(upload.store_key)
+        try:
+            image_file, image_meta = prep_image(f)
+        except IOError as e:
+            # Remove the file so that another can be uploaded
+            backend.delete(upload.store_key)
+            return fail('File appears to be an image but it cannot be read.')
+
+        if image_file is not f:
+            backend.store(image_file, upload.store_key)
+
+        asset.meta.update(image_meta)
+        asset.meta.update({
+            'hash': get_file_hash(image_file),
+            'length': get_file_length(image_file)
+            })
+
+    else:
+        asset.meta['pending'] = True
+
+    # Detect faces in images on upload (if configured)
+    detect_faces = ''
+    if asset.type == 'image' and current_app.config['SUPPORT_FACE_DETECTION']:
+        detect_faces = current_app.config['FACE_DETECTION_ON_UPLOAD']
+
+    if detect_faces == 'wait':
+        try:
+            asset.detect_faces(Image.open(image_file))
+        except FaceDetectionPoolBusy:
+            return fail('Face detection is busy, please try again later.')
+
+    # Save the asset
+    try:
+        asset.insert()
+    except DuplicateKeyError:
+        # The upload has already been completed
+        return fail('Upload not found.')
+
+    # Claim the upload. If it's been purged (because it expired) in the
+    # meantime its file is only kept if the asset was saved first.
+    if not upload.claim() and backend.get_length(upload.store_key) is None:
+        asset.delete()
+        return fail('Upload not found.')
+
+    if asset.meta.get('pending'):
+        current_app.celery.send_task('prep_asset', [g.account._id, asset.uid])
+
+    if detect_faces == 'background':
+        current_app.celery.send_task(
+            'detect_faces',
+            [g.account._id, asset.uid]
+            )
+
+    return success(asset.to_json_type())
+
+@api.route('/upload-direct', methods=['PUT'])
+def upload_direct():
+    """
+    Receive a file uploaded directly to the application for a backend that
+    doesn't support direct uploads (see `upload_reserve`). The request's body
+    is streamed straight to the backend.
+    """
+
+    # Validate the parameters (only the query string is read, the body is the
+    # file).
+    form = UploadDirectForm(request.args)
+    if not form.validate():
+        return fail('Invalid request', issues=form.errors)
+
+    # Get the upload and account (loaded when the form was validated)
+    upload = form.upload
+    account = form.upload_account
+
+    # Check the size of the file
+    length = request.content_length
+    if not length:
+        return fail('No file sent (`Content-Length` required).')
+
+    if length > current_app.config['UPLOAD_MAX_LENGTH']:
+        return fail('File is too large.')
+
+    # Check a file hasn't already been uploaded
+    backend = account.get_backend_instance()
+    if backend.get_length(upload.store_key) is not None:
+        return fail('A file has already been uploaded.')
+
+    # Store the file (removing any partial file if the upload fails)
+    try:
+        backend.store(request.stream, upload.store_key)
+    except Exception:
+        backend.delete(upload.store_key)
+        raise
+
+    if backend.get_length(upload.store_key) != length:
+        backend.delete(upload.store_key)
+        return fail('The file sent was incomplete.')
+
+    return success({'uid': upload.uid})
+
+@api.route('/upload-reserve', methods=['POST'])
+@authenticated
+def upload_reserve():
+    """
+    Reserve an asset for a file to be uploaded directly to the account's
+    backend (rather than through the application). The details of the request
+    that uploads the file are returned, once the file has been uploaded the
+    upload must be completed (see `upload_complete`).
+    """
+
+    # Validate the parameters
+    form = UploadReserveForm(request.values)
+    if not form.validate():
+        return fail('Invalid request', issues=form.errors)
+    form_data = form.data
+
+    # Name
+    filename = form_data['filename']
+    name = form_data['name']
+    if not name:
+        name = os.path.splitext(filename)[0]
+    name = slugify_name(name)
+
+    # Extension
+    ext = os.path.splitext(filename)[1].lower()[1:]
+
+    # Create the upload
+    config = current_app.config
+    now = time.mktime(datetime.now(timezone.utc).timetuple())
+    upload = Upload(
+        account=g.account._id,
+        uid=generate_asset_uid(g.account),
+        name=name,
+        ext=ext,
+        filename=filename,
+        expires=now + config['UPLOAD_RESERVE_EXPIRES']
+        )
+    upload.store_key = Asset.get_store_key(upload)
+
+    if form_data['expires']:
+        upload.asset_expires = form_data['expires']
+
+    upload.insert()
+
+    # Get the details of the request that uploads the file, backends that
+    # don't support direct uploads are sent the file via the application.
+    backend = g.account.get_backend_instance()
+    request_details = backend.get_upload_form(
+        upload.store_key,
+        Asset.guess_content_type(upload.store_key),
+        config['UPLOAD_MAX_LENGTH'],
+        config['UPLOAD_RESERVE_EXPIRES']
+        )
+
+    if request_details:
+        request_details['method'] = 'POST'
+    else:
+        request_details = {
+            'method': 'PUT',
+            'url': url_for(
+                'api.upload_direct',
+                account=g.account.name,
+                uid=upload.uid,
+                sig=g.account.sign('upload:' + upload.uid),
+                _external=True
+                ),
+            'fields': {}
+            }
+
+    return success({
+        'uid': upload.uid,
+        'store_key': upload.store_key,
+        'expires': upload.expires,
+        'upload': request_details
+        })
+
+@api.route('/variation')
+def variation():
+    """
+    Serve a variation of an image asset for a list of ops, the variation is
+    generated (and stored) the first time it's requested.
+    """
+
+    # Validate the parameters
+    form = VariationForm(request.values)
+    if not form.validate():
+        return fail('Invalid request', issues=form.errors)
+    form_data = form.data
+
+    # Get the asset and account (loaded when the form was validated)
+    asset = form.asset
+    account = form.asset_account
+
+    # Find the variation for the ops, if it doesn't exist generate it
+    ops = json.loads(form_data['ops'])
+    ops_hash = Variation.get_ops_hash(ops)
+    backend = account.get_backend_instance()
+
+    variation = asset.fetch_variation(ops_hash)
+    if not variation:
+        # Retrieve the original file
+        f = backend.retrieve(asset.backend_key)
+        im = Image.open(f)
+
+        # Generate the variation (named after the hash of its ops)
+        asset.account = account
+        try:
+            variation = asset.add_variation(f, im, ops_hash, ops)
+        except FaceDetectionPoolBusy:
+            return fail('Face detection is busy, please try again later.')
+
+        # Update the assets modified timestamp
+        asset.update('modified')
+
+    # Serve the variation (the variation for a set of ops never changes)
+    return file_response(
+        backend,
+        variation.backend_key,
+        Asset.guess_content_type(variation.store_key),
+        length=(variation.meta or {}).get('length'),
+        etag=variation.etag,
+        max_age=current_app.config['DOWNLOAD_CACHE_MAX_AGE']
+        )
+
 
 # Utils
 
 def prep_image(f):
-    """Prepare an image as a file"""
+    """
+    Prepare an image as a file, orienting the image and stripping any meta data
+    from it.
+
+    Images are decoded and (if required) encoded once, JPEGs that are already
+    upright and hold no meta data are left untouched and where possible other
+    JPEGs are oriented and stripped losslessly (see `utils.jpeg`).
+    """
 
     # Attempt to load the image
     im = Image.open(f)
     fmt = im.format
 
-    # Orient the image
+    # Find the orientation of the image
+    orientation = None
     if hasattr(im, '_getexif') and im._getexif():
         # Only JPEG images contain the _getexif tag, however if it's present we
         # can use it make sure the image is correctly orientated.
@@ -318,52 +687,102 @@ def prep_image(f):
         # Convert the exif data to a dictionary with alphanumeric keys
         exif = {TAGS[k]: v for k, v in im._getexif().items() if k in TAGS}
 
-        # Check for an orientation setting and orient the image if required
+        # Check for an orientation setting
         orientation = exif.get('Orientation')
-        if orientation == 2:
-            im = im.transpose(Image.FLIP_LEFT_RIGHT)
-        elif orientation == 3:
-            im = im.transpose(Image.ROTATE_180)
-        elif orientation == 4:
-            im = im.transpose(Image.FLIP_TOP_BOTTOM)
-        elif orientation == 5:
-            im = im.transpose(Image.FLIP_LEFT_RIGHT)
-            im = im.transpose(Image.ROTATE_90)
-        elif orientation == 6:
-            im = im.transpose(Image.ROTATE_270)
-        elif orientation == 7:
-            im = im.transpose(Image.FLIP_TOP_BOTTOM)
-            im = im.transpose(Image.ROTATE_90)
-        elif orientation == 8:
-            im = im.transpose(Image.ROTATE_90)
-
-        # Convert the image back to a stream
-        f = io.BytesIO()
-        im.save(f, format=fmt)
-        f.seek(0)
 
+    transposes = ORIENTATION_TRANSPOSES.get(orientation, [])
 
-    # Strip meta data from file
-    im_no_exif = None
-    if im.format == 'GIF':
-        im_no_exif = im
+    if fmt == 'GIF' or (fmt == 'JPEG' and not transposes \
+            and not has_jpeg_meta(im)):
+        # GIFs, and JPEGs that are upright and hold no meta data, are stored as
+        # they are.
+        f.seek(0)
+        return f, get_image_meta(im)
+
+    if fmt == 'JPEG':
+        # Where possible orient and strip JPEGs without decoding them
+        f.seek(0)
+        data = f.read()
+
+        if transposes:
+            oriented = jpeg.orient(data, orientation)
+            if oriented:
+                meta = get_image_meta(im)
+                if orientation in (5, 6, 7, 8):
+                    meta['image']['size'] = tuple(reversed(im.size))
+                return io.BytesIO(oriented), meta
+
+        else:
+            try:
+                return io.BytesIO(jpeg.strip_meta(data)), get_image_meta(im)
+            except (IndexError, ValueError):
+                pass
+
+    # Orient the image, transposing the image gives us a new image that doesn't
+    # hold the original's format specific meta data, otherwise we strip the
+    # meta data from a copy.
+    if transposes:
+        for transpose in transposes:
+            im = im.transpose(transpose)
+        im.info = {}
     else:
-        f = io.BytesIO()
-        im_no_exif = Image.new(im.mode, im.size)
-        im_no_exif.putdata(list(im.getdata()))
-        im_no_exif.save(f, format=fmt)
+        im = strip_meta(im)
 
+    # Convert the image back to a stream
+    f = io.BytesIO()
+    im.save(f, format=fmt)
     f.seek(0)
 
-    # Extract any available meta information
-    meta = {
+    return f, get_image_meta(im)
+
+def generate_asset_uid(account):
+    """
+    Return a unique Id for a new asset (not used by an existing asset or
+    upload reservation).
+    """
+    while True:
+        uid = generate_uid(6)
+        query = And(Q.account == account, Q.uid == uid)
+        if Asset.count(query) == 0 and Upload.count(query) == 0:
+            return uid
+
+def get_image_meta(im):
+    """Return the meta information stored against an image asset"""
+    return {
         'image': {
             'mode': im.mode,
             'size': im.size
         }
     }
 
-    return f, meta
+def has_jpeg_meta(im):
+    """
+    Return True if a JPEG holds meta data (EXIF, XMP, ICC profiles, comments,
+    thumbnails, etc.) in addition to the JFIF and Adobe headers required to
+    decode it.
+    """
+    for marker, data in im.applist:
+        if marker == 'APP0' and data.startswith(b'JFIF\x00'):
+            continue
+
+        if marker == 'APP14' and data.startswith(b'Adobe'):
+            continue
+
+        return True
+
+    return False
+
+def strip_meta(im):
+    """Return a copy of an image without any meta data (e.g. EXIF)"""
+
+    # Copying the image copies its pixel data (and palette) as a single buffer
+    # into a plain image, meta data is held against the original image's
+    # `info` (as well as format specific attributes that aren't copied) so we
+    # clear it.
+    im_no_meta = im.copy()
+    im_no_meta.info = {}
+
+    return im_no_meta
 
 def slugify_name(name):
     """Get a slugifier used to ensure asset names are safe"""
@@ -5,12 +5,17 @@ Initialization of the application.
 import argparse
 from celery import Celery
 from celery.bin import Option
+from celery.signals import worker_process_init
 from flask import Flask, jsonify
 from mongoframes import Frame
 import pymongo
 from raven.contrib.flask import Sentry
 from werkzeug.contrib.fixers import ProxyFix
 
+from utils.cache import LRUCache
+from utils.faces import FaceDetectionPool
+from utils.uploads import UploadRequest
+
 
 __all__ = ['create_app']
 
@@ -23,8 +28,10 @@ def create_app(env):
     command line at start up.
     """
 
-    # Create the app
+    # Create the app, uploaded files are received using a custom request class
+    # (see `UploadRequest`).
     app = Flask(__name__)
+    app.request_class = UploadRequest
 
     # Configure the application to the specified config
     app.config['ENV'] = env
@@ -37,6 +44,36 @@ def create_app(env):
     if app.config['SENTRY_DSN']:
         app.sentry = sentry.init_app(app)
 
+    # Add per-process caches for accounts (see `Account.by_api_key`) and
+    # backend instances (see `Account.get_backend_instance`).
+    app.account_cache = LRUCache(
+        app.config['ACCOUNT_CACHE_SIZE'],
+        ttl=app.config['ACCOUNT_CACHE_TTL']
+        )
+    app.backend_cache = LRUCache(app.config['BACKEND_CACHE_SIZE'])
+
+    # Add a pool of processes for face detection. The pool's processes are
+    # started once the application is serving requests or (in celery's
+    # worker processes) running tasks, not when the application is created
+    # as the application may be forked (and the pool can't be) or may never
+    # detect faces (e.g. management commands).
+    app.face_pool = None
+    if app.config['SUPPORT_FACE_DETECTION'] \
+            and app.config['FACE_DETECTION_PROCESSES'] > 0:
+        app.face_pool = FaceDetectionPool(
+            app.config['FACE_DETECTION_PROCESSES'],
+            app.config['FACE_DETECTION_QUEUE_SIZE'],
+            app.config['FACE_DETECTION_SIZE'],
+            app.config['FACE_DETECTION_UPSAMPLE'],
+            app.config['FACE_DETECTION_TIMEOUT']
+            )
+
+        def start_face_pool(**kwargs):
+            app.face_pool.start()
+
+        app.before_first_request(start_face_pool)
+        worker_process_init.connect(start_face_pool, weak=False)
+
     # Add mongo support
     app.mongo = pymongo.MongoClient(app.config['MONGO_URI'])
     app.db = app.mongo.get_default_database()
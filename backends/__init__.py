@@ -25,6 +25,10 @@ class Backend:
     # `WTForm.Form` instance.
     config_form = None
 
+    # The size (in bytes) of the chunks a file is read in when streamed from
+    # the store.
+    chunk_size = 64 * 1024
+
     def __init__(self, **config):
         raise NotImplementedError()
 
@@ -32,6 +36,37 @@ class Backend:
         """Delete a file from the store"""
         raise NotImplementedError()
 
+    def get_download_url(self, key, content_type=None, filename=None):
+        """
+        Return a (short-lived) URL the file can be downloaded from directly,
+        backends that don't support direct downloads (or are configured not
+        to) return `None`. If a filename is given the file should be served as
+        an attachment.
+        """
+        return None
+
+    def get_length(self, key):
+        """
+        Return the length (in bytes) of a file in the store, or `None` if
+        there's no file stored with the key.
+        """
+        raise NotImplementedError()
+
+    def get_local_path(self, key):
+        """
+        Return the absolute path to a file on the local file system, backends
+        that don't store files locally return `None`.
+        """
+        return None
+
+    def get_upload_form(self, key, content_type, max_length, expires):
+        """
+        Return the details (`url` and form `fields`) of a (short-lived) POST
+        request that uploads a file directly to the store under the given key,
+        backends that don't support direct uploads return `None`.
+        """
+        return None
+
     def retrieve(self, key):
         """Retrieve a file from the store"""
         raise NotImplementedError()
@@ -40,6 +75,22 @@ class Backend:
         """Store a file"""
         raise NotImplementedError()
 
+    def stream(self, key):
+        """
+        Return a generator that yields the contents of a file in the store as a
+        series of chunks (byte strings), allowing large files to be sent
+        without reading them into memory in full.
+        """
+        raise NotImplementedError()
+
+    def stream_range(self, key, start, end):
+        """
+        Return a generator that yields a range of bytes (from `start` to `end`
+        inclusive) from a file in the store as a series of chunks, only the
+        bytes requested are read from the store.
+        """
+        raise NotImplementedError()
+
     @classmethod
     def validate_config(cls, **config):
         """Validate a set of config values"""
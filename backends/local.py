@@ -46,6 +46,16 @@ class LocalBackend(Backend):
         if os.path.exists(abs_path):
             os.remove(abs_path)
 
+    def get_length(self, key):
+        """Return the length of a file in the store"""
+        abs_path = os.path.join(self.asset_root, key)
+        if os.path.isfile(abs_path):
+            return os.path.getsize(abs_path)
+
+    def get_local_path(self, key):
+        """Return the absolute path to a file on the local file system"""
+        return os.path.abspath(os.path.join(self.asset_root, key))
+
     def retrieve(self, key):
         """Retrieve a file from the store"""
 
@@ -66,6 +76,36 @@ class LocalBackend(Backend):
         # Ensure the location exists
         os.makedirs(abs_path, exist_ok=True)
 
-        # Save the file
+        # Save the file (copying it a chunk at a time)
         with open(os.path.join(abs_path, filename), 'wb') as store:
-            store.write(f.read())
\ No newline at end of file
+            shutil.copyfileobj(f, store, self.chunk_size)
+
+    def stream(self, key):
+        """Return a generator that yields the file in chunks"""
+
+        # Read the file a chunk at a time
+        abs_path =  os.path.join(self.asset_root, key)
+        with open(abs_path, 'rb') as f:
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def stream_range(self, key, start, end):
+        """
+        Return a generator that yields a range of bytes from the file in chunks
+        """
+
+        # Seek to the start of the range and read the file a chunk at a time
+        # until we reach the end of it.
+        abs_path =  os.path.join(self.asset_root, key)
+        with open(abs_path, 'rb') as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
\ No newline at end of file
@@ -1,15 +1,17 @@
 import boto3
 from botocore.client import ClientError
+from botocore.exceptions import BotoCoreError
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from flask import current_app
 import io
-import os
-import tempfile
-import uuid
+import time
 from wtforms import Form, ValidationError
 from wtforms.fields import *
 from wtforms.validators import *
 
 from backends import Backend
 from models.assets import Asset
+from utils import get_file_length
 
 __all__ = ['S3Backend']
 
@@ -28,6 +30,16 @@ class ConfigForm(Form):
         'Please specify the S3 `bucket` that will store the assets',
         [Required()]
         )
+    presign_expires = StringField(
+        'Optionally specify the number of seconds (`presign_expires`) \
+presigned download URLs are valid for (if not specified files are downloaded \
+via the application)'
+        )
+
+    def validate_presign_expires(form, field):
+        """Validate the expiry for presigned URLs is a number of seconds"""
+        if field.data and not (field.data.isdigit() and int(field.data) > 0):
+            raise ValidationError('Must be a number of seconds.')
 
     def validate_access_key(form, field):
         access_key = field.data
@@ -60,54 +72,237 @@ class S3Backend(Backend):
     config_form = ConfigForm
 
     def __init__(self, **config):
-        self.s3 =  boto3.resource(
-            's3',
+        # Backend instances are shared between threads so we use the low-level
+        # client (which unlike boto3's resources is thread-safe).
+        session = boto3.session.Session(
             aws_access_key_id=config['access_key'],
             aws_secret_access_key=config['secret_key']
         )
-        self.bucket = self.s3.Bucket(config['bucket'])
+        self.client = session.client('s3')
+        self.bucket = config['bucket']
+
+        # Downloads are only redirected to presigned URLs if an expiry is set
+        self.presign_expires = int(config.get('presign_expires') or 0)
 
     def delete(self, key):
         """Delete a file from the store"""
-        self.bucket.delete_objects(Delete={'Objects': [{'Key': key}]})
+        self.client.delete_object(Bucket=self.bucket, Key=key)
 
-    def retrieve(self, key):
-        """Retrieve a file from the store"""
+    def get_download_url(self, key, content_type=None, filename=None):
+        """
+        Return a presigned URL the file can be downloaded from directly (see
+        `presign_expires`), or `None` if presigned URLs aren't enabled.
+        """
+        if not self.presign_expires:
+            return None
 
-        # Create a temporary directory to download the file to
-        with tempfile.TemporaryDirectory() as dirname:
+        # Have S3 serve the file with the same headers we would
+        params = {'Bucket': self.bucket, 'Key': key}
+        if content_type:
+            params['ResponseContentType'] = content_type
+        if filename:
+            params['ResponseContentDisposition'] = \
+                    'attachment; filename={0}'.format(filename)
+
+        # Presigning is done locally (no request is made to S3)
+        return self.client.generate_presigned_url(
+            'get_object',
+            Params=params,
+            ExpiresIn=self.presign_expires
+            )
+
+    def get_length(self, key):
+        """Return the length of a file in the store"""
+        try:
+            response = self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return None
+            raise
 
-            # Create a temporary filepath to store and retrieve the file from
-            filepath = os.path.join(dirname, uuid.uuid4().hex)
+        return response['ContentLength']
 
-            # Download the file
-            self.bucket.download_file(key, filepath)
+    def get_upload_form(self, key, content_type, max_length, expires):
+        """
+        Return the details of a presigned POST request that uploads a file
+        directly to S3.
+        """
 
-            # Convert the file to a stream
-            with open(filepath, 'rb') as f:
-                stream = io.BytesIO(f.read())
+        # The file must be stored with the same headers we would store it with
+        fields = {'Cache-Control': 'max-age=%d, public' % (365 * 24 * 60 * 60)}
+        if content_type:
+            fields['Content-Type'] = content_type
 
-            # Remove the temporary file
-            os.remove(filepath)
+        conditions = [{k: v} for k, v in fields.items()]
+        conditions.append(['content-length-range', 1, max_length])
 
-            return stream
+        # Presigning is done locally (no request is made to S3)
+        post = self.client.generate_presigned_post(
+            Bucket=self.bucket,
+            Key=key,
+            Fields=fields,
+            Conditions=conditions,
+            ExpiresIn=expires
+            )
+        return {'url': post['url'], 'fields': post['fields']}
+
+    def retrieve(self, key):
+        """Retrieve a file from the store"""
+
+        # Read the object's body straight into memory
+        body = self.client.get_object(Bucket=self.bucket, Key=key)['Body']
+        try:
+            return io.BytesIO(body.read())
+        finally:
+            body.close()
 
     def store(self, f, key):
-        """Store a file"""
+        """
+        Store a file, files larger than the `S3_MULTIPART_THRESHOLD` setting
+        are stored using a multipart upload (see `store_multipart`).
+        """
+
+        # Set the file to be cached to a year from now
+        options = {
+            'CacheControl': 'max-age=%d, public' % (365 * 24 * 60 * 60)
+            }
 
         # Guess the content type
         content_type = Asset.guess_content_type(key)
-
-        # Set the file to be cached to a year from now
-        cache_control = 'max-age=%d, public' % (365 * 24 * 60 * 60)
+        if content_type:
+            options['ContentType'] = content_type
 
         # Store the object
-        obj = self.s3.Object(self.bucket.name, key)
-        if content_type:
-            obj.put(
+        if get_file_length(f) >= current_app.config['S3_MULTIPART_THRESHOLD']:
+            self.store_multipart(f, key, **options)
+        else:
+            self.client.put_object(
+                Bucket=self.bucket,
+                Key=key,
                 Body=f,
-                ContentType=content_type,
-                CacheControl=cache_control
+                **options
                 )
-        else:
-            obj.put(Body=f, CacheControl=cache_control)
\ No newline at end of file
+
+    def store_multipart(self, f, key, **options):
+        """
+        Store a file using a multipart upload. Parts are read from the file in
+        turn and uploaded concurrently (see the `S3_MULTIPART_CONCURRENCY` and
+        `S3_MULTIPART_PART_SIZE` settings), a part that fails to upload is
+        retried on its own. If the upload can't be completed it's aborted.
+        """
+        config = current_app.config
+        part_size = config['S3_MULTIPART_PART_SIZE']
+        concurrency = config['S3_MULTIPART_CONCURRENCY']
+        retries = config['S3_MULTIPART_RETRIES']
+
+        # Start the upload
+        upload_id = self.client.create_multipart_upload(
+            Bucket=self.bucket,
+            Key=key,
+            **options
+            )['UploadId']
+
+        try:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                futures = []
+                pending = set()
+                while True:
+                    data = f.read(part_size)
+                    if not data:
+                        break
+
+                    # Limit the number of parts held in memory to the number
+                    # being uploaded.
+                    if len(pending) >= concurrency:
+                        done, pending = wait(
+                            pending,
+                            return_when=FIRST_COMPLETED
+                            )
+                        for future in done:
+                            future.result()
+
+                    future = executor.submit(
+                        self._upload_part,
+                        key,
+                        upload_id,
+                        len(futures) + 1,
+                        data,
+                        retries
+                        )
+                    futures.append(future)
+                    pending.add(future)
+
+                parts = [future.result() for future in futures]
+
+            # Complete the upload
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={'Parts': parts}
+                )
+
+        except Exception:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket,
+                Key=key,
+                UploadId=upload_id
+                )
+            raise
+
+    def stream(self, key):
+        """Return a generator that yields the file in chunks"""
+
+        # Read the object's body a chunk at a time
+        body = self.client.get_object(Bucket=self.bucket, Key=key)['Body']
+        try:
+            while True:
+                chunk = body.read(self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            body.close()
+
+    def stream_range(self, key, start, end):
+        """
+        Return a generator that yields a range of bytes from the object in
+        chunks.
+        """
+
+        # Only fetch the requested range of the object
+        body = self.client.get_object(
+            Bucket=self.bucket,
+            Key=key,
+            Range='bytes={0}-{1}'.format(start, end)
+            )['Body']
+        try:
+            while True:
+                chunk = body.read(self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            body.close()
+
+    def _upload_part(self, key, upload_id, part_number, data, retries):
+        """Upload a part of a multipart upload (retrying if it fails)"""
+        attempt = 0
+        while True:
+            try:
+                response = self.client.upload_part(
+                    Bucket=self.bucket,
+                    Key=key,
+                    UploadId=upload_id,
+                    PartNumber=part_number,
+                    Body=data
+                    )
+                return {'ETag': response['ETag'], 'PartNumber': part_number}
+
+            except (BotoCoreError, ClientError):
+                if attempt >= retries:
+                    raise
+
+                # Back off before retrying
+                time.sleep(0.5 * 2 ** attempt)
+                attempt += 1
\ No newline at end of file
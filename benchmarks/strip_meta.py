@@ -0,0 +1,76 @@
+"""
+Benchmark stripping meta data from an uploaded image, comparing the pixel by
+pixel copy previously used by `prep_image` with `strip_meta`.
+
+`python benchmarks/strip_meta.py {width} {height}`
+"""
+
+import io
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from api.assets import strip_meta
+
+
+def legacy_strip_meta(im):
+    """Copy the image pixel by pixel (as `prep_image` previously did)"""
+    im_no_meta = Image.new(im.mode, im.size)
+    im_no_meta.putdata(list(im.getdata()))
+    return im_no_meta
+
+def run(func, data, results):
+    """Strip the meta data from an image and record the time and memory used"""
+
+    # Decode the image ahead of measuring
+    im = Image.open(io.BytesIO(data))
+    im.load()
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Strip the meta data and save the image as `prep_image` does
+    start = time.perf_counter()
+    f = io.BytesIO()
+    func(im).save(f, format='jpeg')
+    results.put((
+        time.perf_counter() - start,
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss
+        ))
+
+def main(width, height):
+
+    # Build a test JPEG with EXIF data
+    im = Image.effect_noise((width, height), 64).convert('RGB')
+    f = io.BytesIO()
+    im.save(f, format='jpeg', exif=b'Exif\x00\x00' + b'\x00' * 64)
+    data = f.getvalue()
+
+    print('Stripping meta data from a {0}x{1} JPEG'.format(width, height))
+
+    # Run each method in a separate process so that peak memory use can be
+    # compared.
+    for name, func in [('legacy', legacy_strip_meta), ('strip_meta', strip_meta)]:
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(
+            target=run,
+            args=(func, data, results)
+            )
+        process.start()
+        elapsed, peak_rss = results.get()
+        process.join()
+
+        print('- {name:-<14} {elapsed:.2f}s, +{peak:.0f}MB peak memory'.format(
+            name=name + ' ',
+            elapsed=elapsed,
+            peak=peak_rss / 1024
+            ))
+
+
+if __name__ == '__main__':
+    args = [int(a) for a in sys.argv[1:3]]
+    main(*(args or [6000, 4000]))
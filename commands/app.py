@@ -8,6 +8,8 @@ from mongoframes import *
 from commands import AppCommand
 from models.accounts import Account
 from models.assets import Asset, Variation
+from models.blobs import Blob
+from models.uploads import Upload
 
 
 class Drop(AppCommand):
@@ -30,6 +32,8 @@ class Drop(AppCommand):
         # Drop the collections
         Asset.get_collection().drop()
         Account.get_collection().drop()
+        Blob.get_collection().drop()
+        Upload.get_collection().drop()
 
 
 class Init(AppCommand):
@@ -39,7 +43,9 @@ class Init(AppCommand):
 
     models = [
         Account,
-        Asset
+        Asset,
+        Blob,
+        Upload
         ]
 
     def run(self):
@@ -1,4 +1,5 @@
 from flask import g
+import hmac
 import json
 from mongoframes import *
 from numbers import Number
@@ -7,7 +8,9 @@ from wtforms import Form, ValidationError
 from wtforms.fields import *
 from wtforms.validators import *
 
+from models.accounts import Account
 from models.assets import Asset
+from models.uploads import Upload
 
 __all__ = [
     'DownloadForm',
@@ -15,24 +18,50 @@ __all__ = [
     'GetForm',
     'ListForm',
     'SetExpiresForm',
-    'UploadForm'
+    'UploadCompleteForm',
+    'UploadDirectForm',
+    'UploadForm',
+    'UploadReserveForm',
+    'VariationForm',
+    'validate_image_ops'
     ]
 
 
 class _FindAssetForm(Form):
 
+    # The projection used to load the asset, forms that only need a subset of
+    # the asset's fields should narrow this (`None` loads the full asset).
+    projection = None
+
     uid = StringField('uid')
 
     def validate_uid(form, field):
         """Validate that the asset exists"""
-        asset = Asset.one(And(Q.account == g.account, Q.uid == field.data))
+        kwargs = {}
+        if form.projection is not None:
+            kwargs['projection'] = form.projection
+
+        asset = Asset.one(
+            And(Q.account == g.account, Q.uid == field.data),
+            **kwargs
+            )
         if not asset or asset.expired:
             raise ValidationError('Asset not found.')
 
+        # Store the asset against the form so the view doesn't have to load it
+        # again.
+        form.asset = asset
+
 
 class DownloadForm(_FindAssetForm):
 
-    pass
+    projection = {
+        'blob_key': True,
+        'expires': True,
+        'meta': True,
+        'modified': True,
+        'store_key': True
+        }
 
 
 class GenerateVariationsForm(_FindAssetForm):
@@ -43,6 +72,7 @@ class GenerateVariationsForm(_FindAssetForm):
         [Optional(), AnyOf(['forget', 'wait'])]
         )
     webhook = StringField('webhook', [Optional(), URL()])
+    force = BooleanField('force')
 
     def validate_variations(form, field):
         # A valid name matcher
@@ -62,7 +92,6 @@ class GenerateVariationsForm(_FindAssetForm):
 
         # Validate each item in the dictionary contains a valid set of image
         # operations.
-        supported_formats = Asset.SUPPORTED_IMAGE_EXT['out']
         for name, ops in variations.items():
 
             # Check the variation name is allowed
@@ -70,137 +99,8 @@ class GenerateVariationsForm(_FindAssetForm):
                 raise ValidationError(
                     'Invalid variations name (a-Z, 0-9, -)')
 
-            # Check a list of ops has been specified for the variation
-            if len(ops) == 0:
-                raise ValidationError('Empty ops list'.format(name=name))
-
-            for op in ops:
-                # Validate op is a list with 2 values
-                if not isinstance(op, list) and len(op) != 2:
-                    raise ValidationError('Invalid op [name, value]')
-
-                # Crop
-                if op[0] == 'crop':
-                    # Crop region must be a 4 item list
-                    if not isinstance(op[1], list) and len(op[1]) != 4:
-                         raise ValidationError(
-                            'Invalid crop region [t, r, b, l] (0.0-1.0)')
-
-                    # Check each value is a number
-                    if False in [isinstance(v, Number) for v in op[1]]:
-                         raise ValidationError(
-                            'Invalid crop region [t, r, b, r] (0.0-1.0)')
-
-                    # All values must be between 0 and 1
-                    if False in [v >= 0 and v <= 1 for v in op[1]]:
-                         raise ValidationError(
-                            'Invalid crop region [t, r, b, l] (0.0-1.0)')
-
-                    # Width and height must both be great than 0
-                    if (op[1][2] - op[1][0]) <= 0 or (op[1][1] - op[1][3]) <= 0:
-                         raise ValidationError(
-                            'Invalid crop region, width and height must be ' +
-                            'greater than 0'
-                            )
-
-                # Face
-                elif op[0] == 'face':
-
-                    # Face options must be a dictionary
-                    if not isinstance(op[1], dict):
-                        raise ValidationError(
-                            "Invalid ouput format {'bias': [0.0, -0.2], ...}")
-
-                    # Bias
-                    if 'bias' in op[1]:
-                        bias = op[1]['bias']
-
-                        # Bias must have 2 values
-                        if not isinstance(bias, list) and len(bias) != 2:
-                            raise ValidationError(
-                                'Invalid face bias [horz, vert] as decimals')
-
-                        # Bias values must be numbers
-                        if not (isinstance(bias[0], Number) \
-                                and isinstance(bias[1], Number)):
-                            raise ValidationError(
-                                'Invalid face bias [horz, vert] as decimals')
-
-                    # Padding
-                    if 'padding' in op[1]:
-                        padding = op[1]['padding']
-
-                        # Padding must be a number
-                        if not isinstance(padding, Number):
-                            raise ValidationError(
-                                'Invalid face padding must be a number')
-
-                    # Min padding must be a number
-                    if 'min_padding' in op[1]:
-                        padding = op[1]['min_padding']
-
-                        # Min padding must be a number
-                        if not isinstance(padding, Number):
-                            raise ValidationError(
-                                'Invalid face min padding must be a number')
-
-                # Fit
-                elif op[0] == 'fit':
-                    # Dimensions must be a 2 item list
-                    if not isinstance(op[1], list) and len(op[1]) != 2:
-                        raise ValidationError(
-                            'Invalid fit dimensions [width, height] in pixels')
-
-                    # Dimensions must be integers
-                    if not (isinstance(op[1][0], int) \
-                            and isinstance(op[1][1], int)):
-                        raise ValidationError(
-                            'Invalid fit dimensions [width, height] in pixels')
-
-                    # Dimensions must both be greater than 0
-                    if not (op[1][0] > 0 and op[1][1] > 0):
-                        raise ValidationError(
-                            'Fit dimensions must be greater than 0')
-
-                # Ouput
-                elif op[0] == 'output':
-                    # Format options must be a dictionary
-                    if not isinstance(op[1], dict):
-                        raise ValidationError(
-                            "Invalid ouput format {'format': 'jpg', ...}")
-
-                    # Format must be supported
-                    if op[1].get('format') not in supported_formats:
-                        raise ValidationError(
-                            'Output format not supported ({formats})'.format(
-                                formats='|'.join(supported_formats)
-                                )
-                            )
-
-                    # If quality is specified
-                    fmt = op[1].get('format')
-                    if 'quality' in op[1]:
-                        # Must be a format that supports quality
-                        if fmt not in ['jpg', 'webp']:
-                            raise ValidationError(
-                                'Output quality only allowed for jpg and webp')
-
-                        # Quality must be an integer between 1 and 100
-                        quality = op[1].get('quality')
-                        if not isinstance(quality, int) \
-                                or quality < 0 or quality > 100:
-                            raise ValidationError(
-                                'Invalid output quality (0-100)')
-
-                # Rotate
-                elif op[0] == 'rotate':
-                    if op[1] not in [0, 90, 180, 270]:
-                        raise ValidationError(
-                            'Rotate angle must be 0, 90, 180 or 270')
-
-                # Unknown ops
-                else:
-                    raise ValidationError('Unknown op {op}'.format(op=op[0]))
+            # Check the ops are valid
+            validate_image_ops(ops)
 
 
 class GetForm(_FindAssetForm):
@@ -221,10 +121,268 @@ class ListForm(Form):
 
 class SetExpiresForm(_FindAssetForm):
 
+    projection = {'expires': True}
+
     expires = FloatField('expires', [Optional(), NumberRange(min=1)])
 
 
+class _FindUploadForm(Form):
+
+    uid = StringField('uid')
+
+    def validate_uid(form, field):
+        """Validate that the upload reservation exists"""
+        upload = Upload.one(And(Q.account == g.account, Q.uid == field.data))
+        if not upload or upload.expired:
+            raise ValidationError('Upload not found.')
+
+        form.upload = upload
+
+
+class UploadCompleteForm(_FindUploadForm):
+
+    pass
+
+
+class UploadDirectForm(Form):
+
+    # The request is authorized by signing the upload's uid with the account's
+    # API key, e.g `account.sign('upload:' + uid)`.
+    account = StringField('account', [Required()])
+    sig = StringField('sig', [Required()])
+    uid = StringField('uid', [Required()])
+
+    def validate_account(form, field):
+        """Validate that the account exists"""
+        account = Account.one(Q.name == field.data)
+        if not account:
+            raise ValidationError('Account not found.')
+
+        form.upload_account = account
+
+    def validate_sig(form, field):
+        """Validate the signature"""
+        account = getattr(form, 'upload_account', None)
+        if not account:
+            return
+
+        message = 'upload:{0}'.format(form.uid.data)
+        if not hmac.compare_digest(account.sign(message), field.data):
+            raise ValidationError('Invalid signature.')
+
+    def validate_uid(form, field):
+        """Validate that the upload reservation exists"""
+        account = getattr(form, 'upload_account', None)
+        if not account or form.sig.errors:
+            return
+
+        upload = Upload.one(And(Q.account == account, Q.uid == field.data))
+        if not upload or upload.expired:
+            raise ValidationError('Upload not found.')
+
+        form.upload = upload
+
+
 class UploadForm(Form):
 
     name = StringField('name')
-    expires = FloatField('expires', [Optional(), NumberRange(min=1)])
\ No newline at end of file
+    expires = FloatField('expires', [Optional(), NumberRange(min=1)])
+
+
+class UploadReserveForm(UploadForm):
+
+    filename = StringField('filename', [Required()])
+
+
+class VariationForm(Form):
+
+    # The request is authorized by signing the asset's uid and the ops (as
+    # given) with the account's API key, e.g `account.sign(uid + ':' + ops)`.
+    account = StringField('account', [Required()])
+    sig = StringField('sig', [Required()])
+    uid = StringField('uid', [Required()])
+    ops = StringField('ops', [Required()])
+
+    def validate_account(form, field):
+        """Validate that the account exists"""
+        account = Account.one(Q.name == field.data)
+        if not account:
+            raise ValidationError('Account not found.')
+
+        form.asset_account = account
+
+    def validate_sig(form, field):
+        """Validate the signature"""
+        account = getattr(form, 'asset_account', None)
+        if not account:
+            return
+
+        message = '{0}:{1}'.format(form.uid.data, form.ops.data)
+        if not hmac.compare_digest(account.sign(message), field.data):
+            raise ValidationError('Invalid signature.')
+
+    def validate_uid(form, field):
+        """Validate that the image asset exists"""
+        account = getattr(form, 'asset_account', None)
+        if not account or form.sig.errors:
+            return
+
+        # The asset's variations aren't loaded, the variation requested is
+        # looked up by its ops (see `Asset.fetch_variation`).
+        asset = Asset.one(
+            And(Q.account == account, Q.uid == field.data),
+            projection={'variations': False}
+            )
+        if not asset or asset.expired or asset.type != 'image':
+            raise ValidationError('Asset not found.')
+
+        form.asset = asset
+
+    def validate_ops(form, field):
+        # Check a valid JSON string has been provided
+        try:
+            ops = json.loads(field.data)
+        except ValueError:
+            raise ValidationError('Invalid JSON string')
+
+        # Check the ops are valid
+        validate_image_ops(ops)
+
+
+# Validators
+
+def validate_image_ops(ops):
+    """Validate a list of image operations"""
+
+    # Check a list of ops has been specified
+    if not isinstance(ops, list) or len(ops) == 0:
+        raise ValidationError('Empty ops list')
+
+    supported_formats = Asset.SUPPORTED_IMAGE_EXT['out']
+    for op in ops:
+        # Validate op is a list with 2 values
+        if not isinstance(op, list) and len(op) != 2:
+            raise ValidationError('Invalid op [name, value]')
+
+        # Crop
+        if op[0] == 'crop':
+            # Crop region must be a 4 item list
+            if not isinstance(op[1], list) and len(op[1]) != 4:
+                 raise ValidationError(
+                    'Invalid crop region [t, r, b, l] (0.0-1.0)')
+
+            # Check each value is a number
+            if False in [isinstance(v, Number) for v in op[1]]:
+                 raise ValidationError(
+                    'Invalid crop region [t, r, b, r] (0.0-1.0)')
+
+            # All values must be between 0 and 1
+            if False in [v >= 0 and v <= 1 for v in op[1]]:
+                 raise ValidationError(
+                    'Invalid crop region [t, r, b, l] (0.0-1.0)')
+
+            # Width and height must both be great than 0
+            if (op[1][2] - op[1][0]) <= 0 or (op[1][1] - op[1][3]) <= 0:
+                 raise ValidationError(
+                    'Invalid crop region, width and height must be ' +
+                    'greater than 0'
+                    )
+
+        # Face
+        elif op[0] == 'face':
+
+            # Face options must be a dictionary
+            if not isinstance(op[1], dict):
+                raise ValidationError(
+                    "Invalid ouput format {'bias': [0.0, -0.2], ...}")
+
+            # Bias
+            if 'bias' in op[1]:
+                bias = op[1]['bias']
+
+                # Bias must have 2 values
+                if not isinstance(bias, list) and len(bias) != 2:
+                    raise ValidationError(
+                        'Invalid face bias [horz, vert] as decimals')
+
+                # Bias values must be numbers
+                if not (isinstance(bias[0], Number) \
+                        and isinstance(bias[1], Number)):
+                    raise ValidationError(
+                        'Invalid face bias [horz, vert] as decimals')
+
+            # Padding
+            if 'padding' in op[1]:
+                padding = op[1]['padding']
+
+                # Padding must be a number
+                if not isinstance(padding, Number):
+                    raise ValidationError(
+                        'Invalid face padding must be a number')
+
+            # Min padding must be a number
+            if 'min_padding' in op[1]:
+                padding = op[1]['min_padding']
+
+                # Min padding must be a number
+                if not isinstance(padding, Number):
+                    raise ValidationError(
+                        'Invalid face min padding must be a number')
+
+        # Fit
+        elif op[0] == 'fit':
+            # Dimensions must be a 2 item list
+            if not isinstance(op[1], list) and len(op[1]) != 2:
+                raise ValidationError(
+                    'Invalid fit dimensions [width, height] in pixels')
+
+            # Dimensions must be integers
+            if not (isinstance(op[1][0], int) \
+                    and isinstance(op[1][1], int)):
+                raise ValidationError(
+                    'Invalid fit dimensions [width, height] in pixels')
+
+            # Dimensions must both be greater than 0
+            if not (op[1][0] > 0 and op[1][1] > 0):
+                raise ValidationError(
+                    'Fit dimensions must be greater than 0')
+
+        # Ouput
+        elif op[0] == 'output':
+            # Format options must be a dictionary
+            if not isinstance(op[1], dict):
+                raise ValidationError(
+                    "Invalid ouput format {'format': 'jpg', ...}")
+
+            # Format must be supported
+            if op[1].get('format') not in supported_formats:
+                raise ValidationError(
+                    'Output format not supported ({formats})'.format(
+                        formats='|'.join(supported_formats)
+                        )
+                    )
+
+            # If quality is specified
+            fmt = op[1].get('format')
+            if 'quality' in op[1]:
+                # Must be a format that supports quality
+                if fmt not in ['jpg', 'webp']:
+                    raise ValidationError(
+                        'Output quality only allowed for jpg and webp')
+
+                # Quality must be an integer between 1 and 100
+                quality = op[1].get('quality')
+                if not isinstance(quality, int) \
+                        or quality < 0 or quality > 100:
+                    raise ValidationError(
+                        'Invalid output quality (0-100)')
+
+        # Rotate
+        elif op[0] == 'rotate':
+            if op[1] not in [0, 90, 180, 270]:
+                raise ValidationError(
+                    'Rotate angle must be 0, 90, 180 or 270')
+
+        # Unknown ops
+        else:
+            raise ValidationError('Unknown op {op}'.format(op=op[0]))
\ No newline at end of file
@@ -1,4 +1,10 @@
+from copy import deepcopy
+from flask import current_app
+import hashlib
+import hmac
+import json
 from mongoframes import *
+import time
 from uuid import uuid4
 
 from backends import Backend
@@ -23,30 +29,129 @@ class Account(Frame):
         IndexModel([('api_key', ASC)], unique=True)
     ]
 
+    # The accounts version the account cache was last checked against (see
+    # `by_api_key`).
+    _cache_version = None
+    _cache_checked = 0
+
     def __str__(self):
         return self.name
 
+    def sign(self, message):
+        """
+        Return a signature for a message (a string) signed with the account's
+        API key, signatures allow the account's API key to authorize a request
+        without being included in it (e.g. a URL used in a web page).
+        """
+        return hmac.new(
+            self.api_key.encode('utf8'),
+            message.encode('utf8'),
+            hashlib.sha256
+            ).hexdigest()
+
+    def get_backend_config_hash(self):
+        """Return a hash of the account's backend configuration"""
+        config = json.dumps(self.backend, sort_keys=True)
+        return hashlib.sha1(config.encode('utf8')).hexdigest()
+
     def get_backend_instance(self):
-        """Return a configured instance of the backend for the account"""
+        """
+        Return a configured instance of the backend for the account.
+
+        Instances are cached per process so that connections to the backend are
+        reused across requests. A cached instance is only returned if the
+        account's backend configuration is unchanged since it was created.
+        """
+        cache = current_app.backend_cache
+        config_hash = self.get_backend_config_hash()
+
+        # Check for a cached instance of the backend
+        cached = cache.get(self._id)
+        if cached and cached[0] == config_hash:
+            return cached[1]
+
+        # Create and cache a new instance of the backend
         backendCls = Backend.get_backend(self.backend['backend'])
-        return backendCls(**self.backend)
+        backend = backendCls(**self.backend)
+        cache.set(self._id, (config_hash, backend))
+
+        return backend
 
     def purge(self):
         """Deletes the account along with all related assets and files."""
         from models.assets import Asset
+        from models.uploads import Upload
 
         # Purge all assets
         for asset in Asset.many(Q.account == self):
             asset.account = self
             asset.purge()
 
+        # Purge all upload reservations
+        for upload in Upload.many(Q.account == self):
+            upload.account = self
+            upload.purge()
+
         # Delete self
         self.delete()
 
+    @classmethod
+    def by_api_key(cls, api_key):
+        """
+        Return the account with the given API key, or `None` if there's no
+        matching account.
+
+        Accounts are cached in each process. Changes made by other processes
+        (e.g. management commands) are found by periodically checking the
+        accounts version (see `get_version`).
+        """
+        cache = current_app.account_cache
+
+        # Clear the cache if the accounts have changed since we last checked
+        now = time.time()
+        interval = current_app.config['ACCOUNT_CACHE_CHECK_INTERVAL']
+        if now - Account._cache_checked >= interval:
+            version = cls.get_version()
+            if version != Account._cache_version:
+                cache.clear()
+                Account._cache_version = version
+            Account._cache_checked = now
+
+        # Check for a cached account
+        document = cache.get(api_key)
+        if document is not None:
+            return cls(deepcopy(document))
+
+        # Find the account and cache it
+        account = cls.one(Q.api_key == api_key)
+        if account:
+            cache.set(api_key, deepcopy(account._document))
+
+        return account
+
+    @classmethod
+    def get_version(cls):
+        """
+        Return a version for the accounts collection that changes whenever an
+        account is added, changed or deleted.
+        """
+        latest = cls.one(sort=[('modified', DESC)], projection={'modified': 1})
+        return (cls.count(), latest.modified if latest else None)
+
     @staticmethod
     def generate_api_key():
         return str(uuid4())
 
+    @staticmethod
+    def on_change(sender, frames):
+        # Remove any cached backend instance for changed or deleted accounts
+        for frame in frames:
+            current_app.backend_cache.delete(frame._id)
+
+        # The previous API key for a changed account isn't known so we clear
+        # all cached accounts.
+        current_app.account_cache.clear()
+
     @staticmethod
     def on_insert(sender, frames):
         # Set an API key for newely created accounts
@@ -55,4 +160,6 @@ class Account(Frame):
 
 Account.listen('insert', Account.timestamp_insert)
 Account.listen('insert', Account.on_insert)
-Account.listen('update', Account.timestamp_update)
\ No newline at end of file
+Account.listen('update', Account.timestamp_update)
+Account.listen('updated', Account.on_change)
+Account.listen('deleted', Account.on_change)
\ No newline at end of file
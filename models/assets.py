@@ -1,12 +1,19 @@
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime, timezone
 from flask import current_app
+import hashlib
 import io
+import json
+import math
 import mimetypes
 from mongoframes import *
 import numpy
 from PIL import Image
 import time
 
+from models.blobs import Blob
+
 # Fix for missing mimetypes
 mimetypes.add_type('text/csv', '.csv')
 mimetypes.add_type('image/webp', '.webp')
@@ -30,51 +37,144 @@ class Variation(SubFrame):
         'version',
         'ext',
         'meta',
-        'store_key'
+        'ops_hash',
+        'store_key',
+        'blob_key'
         }
 
     def __str__(self):
         return self.store_key
 
+    @property
+    def backend_key(self):
+        """
+        Return the key the variation's file is stored under in the backend
+        (deduplicated variations are stored as blobs).
+        """
+        return self.blob_key or self.store_key
+
+    @property
+    def etag(self):
+        """
+        Return an ETag for the variation's file, variations are never changed
+        once stored so a hash of the store key is used.
+        """
+        return hashlib.sha1(self.store_key.encode('utf8')).hexdigest()
+
     @staticmethod
-    def find_face(im, bias=None, padding=0, min_padding=0):
+    def compile_ops(ops, size):
         """
-        Find a face in an image and return it's coordinates. If no face can be
-        found then None is returned.
+        Compile a list of operations for an image of the given size, returning
+        the optimized list of image operations to perform and the format to
+        output the resulting image in.
+
+        Image operations are optimized (see `optimize_ops`) up to the first face
+        operation, the region of the image a face operation crops to isn't
+        known ahead of time so any operations that follow it are performed as
+        given.
+        """
+
+        # Separate the output operations from the image operations, the last
+        # output operation determines the format.
+        fmt = {'format': 'jpeg', 'ext': 'jpg'}
+        image_ops = []
+        for op in ops:
+            if op[0] == 'output':
+                fmt = Variation.get_format(op[1])
+            else:
+                image_ops.append(op)
+
+        # Optimize the image operations up to the first face operation
+        face_ops = [i for i, op in enumerate(image_ops) if op[0] == 'face']
+        i = face_ops[0] if face_ops else len(image_ops)
+        image_ops = Variation.optimize_ops(image_ops[:i], size) + image_ops[i:]
+
+        return image_ops, fmt
+
+    @staticmethod
+    def detect_faces(im):
+        """
+        Detect faces in an image and return their rectangles (in the image's
+        coordinates) as a list of `[left, top, right, bottom]` values, ordered
+        by the detector's confidence.
         """
 
-        # Import optional libraries required for face detection
-        import dlib
-        from skimage import io as skimage_io
-        skimage_io.use_plugin('pil')
+        # The detector works on a greyscale version of the image scaled to fit
+        # within the detection size (the time taken to detect faces grows
+        # with the number of pixels in the image).
+        face_im = im.convert('L')
+        detection_size = current_app.config['FACE_DETECTION_SIZE']
+        if max(face_im.size) > detection_size:
+            face_im = face_im.resize(
+                Variation.fit_size(face_im.size, [detection_size] * 2),
+                Image.BILINEAR
+                )
+        x_ratio = im.size[0] / face_im.size[0]
+        y_ratio = im.size[1] / face_im.size[1]
+
+        # Detect faces using the application's face detection pool (if there
+        # is one), otherwise detect faces in this process.
+        face_pool = getattr(current_app, 'face_pool', None)
+        if face_pool:
+            faces = face_pool.detect(face_im)
 
-        # Check we have already aquired a face detector and if not do so now
-        if not hasattr(Variation, '_face_detector'):
-            Variation._face_detector = dlib.get_frontal_face_detector()
+        else:
+            # Import optional libraries required for face detection
+            import dlib
+
+            # Check we have already aquired a face detector and if not do so
+            # now.
+            if not hasattr(Variation, '_face_detector'):
+                Variation._face_detector = dlib.get_frontal_face_detector()
+
+            # Detect faces (the array is built from the image's buffer rather
+            # than pixel by pixel).
+            faces = Variation._face_detector(
+                numpy.asarray(face_im),
+                current_app.config['FACE_DETECTION_UPSAMPLE']
+                )
+            faces = [(f.left(), f.top(), f.right(), f.bottom()) for f in faces]
+
+        # Scale the rectangles to the image's size
+        return [
+            [
+                max(int(l * x_ratio), 0),
+                max(int(t * y_ratio), 0),
+                min(int((r + 1) * x_ratio), im.size[0]),
+                min(int((b + 1) * y_ratio), im.size[1])
+            ]
+            for l, t, r, b in faces
+            ]
 
-        # Convert the image to an array that can be read by skimage
-        w, h = im.size
-        skimage_im = numpy.array(im.getdata(), numpy.uint8).reshape(h, w, 3)
+    @staticmethod
+    def find_face(im, bias=None, padding=0, min_padding=0, faces=None):
+        """
+        Find a face in an image and return it's coordinates. If no face can be
+        found then None is returned.
 
-        d = dlib.get_frontal_face_detector()
-        faces = d(skimage_im, 1)
+        Faces already detected in the image can be provided as a list of
+        rectangles (see `detect_faces`), otherwise the image is searched for
+        faces.
+        """
 
         # Detect faces
-        faces = Variation._face_detector(skimage_im, 1)
+        if faces is None:
+            faces = Variation.detect_faces(im)
 
         # If no faces were detected there's nothing more to do, we return `None`
         if len(faces) == 0:
             return
 
         # If a face was found apply any bias and padding to it
-        face = faces[0]
-        rect = [face.left(), face.top(), face.right(), face.bottom()]
+        rect = list(faces[0])
+        face_w = rect[2] - rect[0]
+        face_h = rect[3] - rect[1]
 
         # Apply bias
         if bias:
             # Shift the center of the face
-            bias_x = int(face.width() * bias[0])
-            bias_y = int(face.width() * bias[1])
+            bias_x = int(face_w * bias[0])
+            bias_y = int(face_w * bias[1])
             rect[0] += bias_x
             rect[1] += bias_y
             rect[2] += bias_x
@@ -92,8 +192,8 @@ class Variation(SubFrame):
 
             # Calculate the padding to apply
             pad = [
-                int(face.width() * padding),
-                int(face.height() * padding)
+                int(face_w * padding),
+                int(face_h * padding)
                 ]
 
             # Ensure that the minimum padding is observed
@@ -111,6 +211,58 @@ class Variation(SubFrame):
 
         return rect
 
+    @staticmethod
+    def get_ops_hash(ops):
+        """
+        Return a hash for a list of operations, lists of operations that
+        produce the same variation (once normalized, see `normalize_ops`)
+        produce the same hash.
+        """
+        ops = Variation.normalize_ops(ops)
+        ops = json.dumps(ops, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha1(ops.encode('utf8')).hexdigest()
+
+    @staticmethod
+    def get_source_size(size, ops):
+        """
+        Return the smallest size an image of the given size could be decoded at
+        and still produce the same variation for the given ops, e.g. an image
+        that's cropped in half and fitted to 100x100 only needs to be 200x200.
+
+        The ops are compiled against the image's full size (see `compile_ops`),
+        an image decoded at a smaller size must be transformed using the
+        compiled ops scaled to that size (see `scale_ops`).
+        """
+        ops, fmt = Variation.compile_ops(ops, size)
+
+        # Only ops that have been optimized to a box, resize and rotate can be
+        # scaled, and without a resize the full size image is required.
+        box = [0, 0, size[0], size[1]]
+        resize = None
+        for op in ops:
+            if op[0] == 'box':
+                box = op[1]
+
+            elif op[0] == 'resize':
+                resize = op[1]
+
+            elif op[0] != 'rotate':
+                return size
+
+        if resize is None:
+            return size
+
+        # The image must be large enough that the region of the image boxed is
+        # no smaller than the size it's resized to.
+        scale = max(
+            resize[0] / (box[2] - box[0]),
+            resize[1] / (box[3] - box[1])
+            )
+        return (
+            min(size[0], int(math.ceil(size[0] * scale))),
+            min(size[1], int(math.ceil(size[1] * scale)))
+            )
+
     @staticmethod
     def get_store_key(asset, variation):
         """Return the store key for an asset variation"""
@@ -123,201 +275,546 @@ class Variation(SubFrame):
             ])
 
     @staticmethod
-    def optimize_ops(ops):
+    def normalize_ops(ops):
+        """
+        Return a normalized version of a list of operations, operations that
+        have no effect are removed and the output operation (only the last of
+        which has any effect) is moved to the end.
         """
-        Optimize/reduce a list of image operations to the fewest possible
-        operations to achieve the same image transform.
+        fmt = {'format': 'jpg'}
+        normalized_ops = []
+        for op in ops:
+
+            # Output
+            if op[0] == 'output':
+                fmt = op[1]
+                continue
+
+            # Crop
+            if op[0] == 'crop':
+                op = ['crop', [float(v) for v in op[1]]]
 
-        Due to the limited set of image operations that are possible we can
-        always reduce the operations list to a limited ordered set, e.g:
+            # Face
+            elif op[0] == 'face':
+                options = {
+                    k: v for k, v in op[1].items()
+                    if k == 'bias' or v != 0
+                    }
+                if options.get('bias') in [None, [0, 0]]:
+                    options.pop('bias', None)
+                op = ['face', options]
 
-        - crop
+            # Rotate
+            elif op[0] == 'rotate':
+                if op[1] == 0:
+                    continue
+
+            normalized_ops.append(op)
+
+        normalized_ops.append(['output', fmt])
+
+        return normalized_ops
+
+    @staticmethod
+    def optimize_ops(ops, size):
+        """
+        Optimize/reduce a list of crop, fit and rotate operations for an image
+        of the given size to the fewest possible operations that achieve the
+        same image transform, always:
+
+        - box (crop to a region of the image in pixels)
+        - resize (to an exact size in pixels)
         - rotate
-        - face (if supported)
-        - fit
-        - output
 
+        Each operation in the list given would require a full pass over the
+        image. Instead we track the region of the original image that would
+        remain, the size it would be scaled to and the angle it would be
+        rotated by, reproducing the pixel rounding of each operation so that
+        the size of the resulting image is always the same.
         """
 
-        def rotate_crop_cw(crop):
-            # Rotate a crop region 90 degrees clockwise
-            crop = [c - 0.5 for c in crop]
-            crop[1] *= -1
-            crop[3] *= -1
-            crop = [c + 0.5 for c in crop]
-            crop.append(crop.pop(0))
-            return crop
+        def to_source(u, v, angle):
+            # Convert a point within the current image (as a fraction of its
+            # width and height) to a point within the region of the original
+            # image it was taken from.
+            if angle == 90:
+                return v, 1 - u
+            elif angle == 180:
+                return 1 - u, 1 - v
+            elif angle == 270:
+                return 1 - v, u
+            return u, v
 
         # Initial transform settings
         angle = 0
-        crop = [0, 1, 1, 0]
-        fit = None
-        fmt = None
-        face = None
+        box = [0, 0, size[0], size[1]]
+        w, h = size
 
         # Optimize the ops
         for op in ops:
+
             if op[0] == 'crop':
-                # Apply the crop as a crop of the last crop
-                sub_crop = list(op[1])
-
-                # Rotate the crop to be aligned with the current angle
-                for i in range(0, int(angle / 90)):
-                    sub_crop = rotate_crop_cw(sub_crop)
-
-                # Crop the existing crop
-                w = crop[1] - crop[3]
-                h = crop[2] - crop[0]
-
-                crop = [
-                    crop[0] + (h * sub_crop[0]),        # Top
-                    crop[1] - (w * (1 - sub_crop[1])),  # Right
-                    crop[2] - (h * (1 - sub_crop[2])),  # Bottom
-                    crop[3] + (w * sub_crop[3])         # Left
-                ]
+                # Find the region of the current image to crop in pixels (as
+                # the crop op would).
+                left = int(op[1][3] * w)
+                top = int(op[1][0] * h)
+                right = int(op[1][1] * w)
+                bottom = int(op[1][2] * h)
+
+                # If the image is cropped away to nothing there's no region
+                # left to track so the ops are performed as given.
+                if right <= left or bottom <= top:
+                    return list(ops)
+
+                # Map the region to the original image
+                box_w = box[2] - box[0]
+                box_h = box[3] - box[1]
+                p0, q0 = to_source(left / w, top / h, angle)
+                p1, q1 = to_source(right / w, bottom / h, angle)
+                box = [
+                    box[0] + min(p0, p1) * box_w,
+                    box[1] + min(q0, q1) * box_h,
+                    box[0] + max(p0, p1) * box_w,
+                    box[1] + max(q0, q1) * box_h
+                    ]
 
-            elif op[0] == 'face':
-                face = op[1]
+                w, h = right - left, bottom - top
 
             elif op[0] == 'fit':
-                # Set the fit dimensions allowing for the current orientation of
-                # the image.
-                if angle in [0, 180]:
-                    fit = [op[1][0], op[1][1]]
-                else:
-                    fit = [op[1][1], op[1][0]]
-
-            elif op[0] == 'output':
-                fmt = op[1]
+                w, h = Variation.fit_size((w, h), op[1])
 
             elif op[0] == 'rotate':
                 # Set the rotation of the image clamping it to (0, 90, 180, 270)
                 angle = (angle + op[1]) % 360
+                if op[1] in [90, 270]:
+                    w, h = h, w
 
         # Build the optimized list of ops
         less_ops = []
 
-        # Crop
-        if crop != [0, 1, 1, 0]:
-            less_ops.append(['crop', crop])
+        # Box
+        box = [int(round(v)) for v in box]
+        if box != [0, 0, size[0], size[1]]:
+            less_ops.append(['box', box])
+
+        # Resize (the image is resized ahead of being rotated)
+        if angle in [90, 270]:
+            w, h = h, w
+
+        if [w, h] != [box[2] - box[0], box[3] - box[1]]:
+            less_ops.append(['resize', [w, h]])
 
         # Rotate
         if angle != 0:
             less_ops.append(['rotate', angle])
 
+        return less_ops
+
+    @staticmethod
+    def scale_ops(ops, size, scaled_size):
+        """
+        Scale a list of compiled operations for an image of the given size (see
+        `compile_ops`) so they can be performed against the image decoded at a
+        smaller size (see `get_source_size`).
+
+        Only the region boxed is scaled, the image is still resized to the same
+        size, so the variation produced is the same size whatever size the
+        image is decoded at.
+        """
+        if tuple(scaled_size) == tuple(size):
+            return ops
+
+        # Ops that haven't been optimized can't be scaled
+        box = [0, 0, size[0], size[1]]
+        resize = None
+        rotate_ops = []
+        for op in ops:
+            if op[0] == 'box':
+                box = op[1]
+
+            elif op[0] == 'resize':
+                resize = op[1]
+
+            elif op[0] == 'rotate':
+                rotate_ops.append(op)
+
+            else:
+                return ops
+
+        # Scale the box
+        x_scale = scaled_size[0] / size[0]
+        y_scale = scaled_size[1] / size[1]
+        scaled_box = [
+            int(round(box[0] * x_scale)),
+            int(round(box[1] * y_scale)),
+            min(int(round(box[2] * x_scale)), scaled_size[0]),
+            min(int(round(box[3] * y_scale)), scaled_size[1])
+            ]
+
+        scaled_ops = []
+        if scaled_box != [0, 0, scaled_size[0], scaled_size[1]]:
+            scaled_ops.append(['box', scaled_box])
+
+        # Resize to the size the full size image would be resized (or boxed) to
+        scaled_ops.append([
+            'resize',
+            resize or [box[2] - box[0], box[3] - box[1]]
+            ])
+
+        return scaled_ops + rotate_ops
+
+    @staticmethod
+    def apply_op(im, op, faces=None):
+        """
+        Perform an image operation against an image and return the resulting
+        image (the image given is never modified). Output operations have no
+        effect on the image and are ignored.
+
+        If the faces within the image are known (as normalized rectangles) they
+        are used by face operations instead of detecting faces in the image.
+        """
+
+        # Box
+        if op[0] == 'box':
+            im = im.crop(op[1])
+
+        # Crop
+        elif op[0] == 'crop':
+            im = im.crop([
+                int(op[1][3] * im.size[0]), # Left
+                int(op[1][0] * im.size[1]), # Top
+                int(op[1][1] * im.size[0]), # Right
+                int(op[1][2] * im.size[1])  # Bottom
+                ])
+
         # Face
-        if face is not None:
-            less_ops.append(['face', face])
+        elif op[0] == 'face':
+            # If face detection isn't supported ignore the operation
+            if not current_app.config['SUPPORT_FACE_DETECTION']:
+                return im
+
+            # Attempt to find the face
+            if faces is not None:
+                faces = Variation.get_face_rects(faces, im.size)
+            face_rect = Variation.find_face(im, faces=faces, **op[1])
+
+            # If no face is detected there's nothing more to do
+            if face_rect is None:
+                return im
+
+            # If a face was found crop it from the image
+            im = im.crop(face_rect)
 
         # Fit
-        if fit is not None:
-            less_ops.append(['fit', fit])
+        elif op[0] == 'fit':
+            size = Variation.fit_size(im.size, op[1])
+            if size != im.size:
+                im = im.resize(size, Image.ANTIALIAS)
 
-        # Output
-        if fmt is not None:
-            less_ops.append(['output', fmt])
+        # Resize
+        elif op[0] == 'resize':
+            if tuple(op[1]) != im.size:
+                im = im.resize(tuple(op[1]), Image.ANTIALIAS)
 
-        return less_ops
+        # Rotate
+        elif op[0] == 'rotate':
+            if op[1] == 90:
+                im = im.transpose(Image.ROTATE_270)
+
+            elif op[1] == 180:
+                im = im.transpose(Image.ROTATE_180)
+
+            elif op[1] == 270:
+                im = im.transpose(Image.ROTATE_90)
+
+        return im
 
     @staticmethod
-    def transform_image(im, ops):
+    def fit_size(size, bounds):
         """
-        Perform a list of operations against an image and return the resulting
-        image.
+        Return the size an image of the given size is scaled down to in order to
+        fit within the given bounds (preserving its aspect ratio). The size is
+        calculated the same way as by Pillow's `Image.thumbnail` method.
         """
+        w, h = size
+        if w > bounds[0]:
+            h = int(max(h * bounds[0] / w, 1))
+            w = int(bounds[0])
 
-        # Optimize the list of operations
-        #
-        # IMPORTANT! The optimized operations method doesn't work correctly in
-        # a number of cases and therefore has been removed for the moment until
-        # those issues can be resolved (hint I think the stack of operations
-        # needs to be optimized in reverse).
-        #
-        # ~ Anthony Blackshaw <ant@getme.co.uk>, 31 August 2017
-        #
-        # ops = Variation.optimize_ops(ops)
+        if h > bounds[1]:
+            w = int(max(w * bounds[1] / h, 1))
+            h = int(bounds[1])
 
-        # Perform the operations
-        fmt = {'format': 'jpeg', 'ext': 'jpg'}
-        for op in ops:
+        return (w, h)
 
-            # Crop
-            if op[0] == 'crop':
-                im = im.crop([
-                    int(op[1][3] * im.size[0]), # Left
-                    int(op[1][0] * im.size[1]), # Top
-                    int(op[1][1] * im.size[0]), # Right
-                    int(op[1][2] * im.size[1])  # Bottom
-                    ])
+    @staticmethod
+    def get_face_rects(faces, size):
+        """
+        Return a list of normalized face rectangles as rectangles within an
+        image of the given size.
+        """
+        w, h = size
+        return [
+            [int(round(l * w)), int(round(t * h)), int(round(r * w)),
+                int(round(b * h))]
+            for l, t, r, b in faces
+            ]
 
-            # Face
-            elif op[0] == 'face':
-                # If face detection isn't supported ignore the operation
-                if not current_app.config['SUPPORT_FACE_DETECTION']:
-                    continue
+    @staticmethod
+    def get_format(options):
+        """
+        Return the format (the arguments for `Image.save`) for the options of an
+        output operation.
+        """
+        fmt = dict(options)
 
-                # Ensure the image we use to find a face with is RGB format
-                face_im = im.convert('RGB')
+        # Set the extension for the output and the format required by Pillow.
+        fmt['ext'] = fmt['format']
+        if fmt['format'] == 'jpg':
+            fmt['format'] = 'jpeg'
 
-                # Due to performance constraints we don't attempt face
-                # recognition on images over 2000x2000 pixels, instead we scale
-                # the images within these bounds ahead of the action.
-                ratio = 1.0
-                if im.size[0] > 2000 or im.size[1] > 2000:
-                    face_im.thumbnail((2000, 2000), Image.ANTIALIAS)
-                    ratio = float(im.size[0]) / float(face_im.size[0])
+        # Add the optimize flag for JPEGs and PNGs
+        if fmt['format'] in ['jpeg', 'png']:
+            fmt['optimize'] = True
 
-                # Attempt to find the face
-                face_rect = Variation.find_face(face_im, **op[1])
+        # Allow gifs to store multiple frames
+        if fmt['format'] in ['gif', 'webp']:
+            fmt['save_all'] = True
+            fmt['optimize'] = True
 
-                # If no face is detected there's nothing more to do
-                if face_rect is None:
-                    continue
+        return fmt
+
+    @staticmethod
+    def map_faces(faces, op, im):
+        """
+        Return the faces (normalized rectangles) within an image after an image
+        operation is performed against it. If the faces aren't known (None)
+        then None is returned.
+        """
+        if faces is None:
+            return None
 
-                # Scale the rectangle by the reduced ratio
-                if ratio:
-                    face_rect = [int(d * ratio) for d in face_rect]
+        # Find the region of the image the operation crops to (if any)
+        w, h = im.size
+        if op[0] == 'box':
+            rect = op[1]
+
+        elif op[0] == 'crop':
+            rect = [
+                int(op[1][3] * w),
+                int(op[1][0] * h),
+                int(op[1][1] * w),
+                int(op[1][2] * h)
+                ]
 
-                # If a face was found crop it from the image
-                im = im.crop(face_rect)
+        elif op[0] == 'face':
+            if not current_app.config['SUPPORT_FACE_DETECTION']:
+                return faces
 
-            # Fit
-            elif op[0] == 'fit':
-                im.thumbnail(op[1], Image.ANTIALIAS)
+            rect = Variation.find_face(
+                im,
+                faces=Variation.get_face_rects(faces, im.size),
+                **op[1]
+                )
+            if rect is None:
+                return faces
 
-            # Rotate
-            elif op[0] == 'rotate':
-                if op[1] == 90:
-                    im = im.transpose(Image.ROTATE_270)
+        elif op[0] == 'rotate':
+            if op[1] == 90:
+                return [[1 - b, l, 1 - t, r] for l, t, r, b in faces]
 
-                elif op[1] == 180:
-                    im = im.transpose(Image.ROTATE_180)
+            elif op[1] == 180:
+                return [[1 - r, 1 - b, 1 - l, 1 - t] for l, t, r, b in faces]
 
-                elif op[1] == 270:
-                    im = im.transpose(Image.ROTATE_90)
+            elif op[1] == 270:
+                return [[t, 1 - r, b, 1 - l] for l, t, r, b in faces]
 
-            # Output
-            elif op[0] == 'output':
-                fmt = op[1]
+            return faces
+
+        else:
+            # Fits and resizes scale the image (and the faces) uniformly
+            return faces
+
+        # Clip the faces to the cropped region, faces outside of the region are
+        # removed.
+        crop_w = rect[2] - rect[0]
+        crop_h = rect[3] - rect[1]
+        cropped_faces = []
+        for l, t, r, b in faces:
+            face = [
+                min(max((l * w - rect[0]) / crop_w, 0.0), 1.0),
+                min(max((t * h - rect[1]) / crop_h, 0.0), 1.0),
+                min(max((r * w - rect[0]) / crop_w, 0.0), 1.0),
+                min(max((b * h - rect[1]) / crop_h, 0.0), 1.0)
+                ]
+            if face[2] > face[0] and face[3] > face[1]:
+                cropped_faces.append(face)
+
+        return cropped_faces
+
+    @staticmethod
+    def transform_image(im, ops, faces=None):
+        """
+        Perform a list of operations against an image and return the resulting
+        image. The faces within the image can be provided as normalized
+        rectangles (see `Asset.detect_faces`).
+        """
+
+        # Perform the operations
+        ops, fmt = Variation.compile_ops(ops, im.size)
+        for op in ops:
+            next_faces = Variation.map_faces(faces, op, im)
+            im = Variation.apply_op(im, op, faces)
+            faces = next_faces
+
+        return Variation.web_safe_image(im, fmt), fmt
 
-                # Set the extension for the output and the format required by
-                # Pillow.
-                fmt['ext'] = fmt['format']
-                if fmt['format'] == 'jpg':
-                    fmt['format'] = 'jpeg'
+    @staticmethod
+    def transform_images(
+        im,
+        variations,
+        faces=None,
+        size=None,
+        submit=None
+        ):
+        """
+        Perform the operations for a set of variations (a dictionary of names
+        and ops) against an image, yielding the name, resulting image and format
+        for each variation in turn. The faces within the image can be provided
+        as normalized rectangles (see `Asset.detect_faces`).
+
+        If the image has been decoded at a smaller size (see `Image.draft`)
+        the image's full size must be given, the operations are compiled for
+        the full size image and then scaled (see `scale_ops`).
+
+        Rather than transforming the image separately for each variation:
+
+        - variations with a common prefix of (optimized) operations (e.g the
+          same crop) share the intermediate images produced by the prefix,
+        - images fitted to different sizes from the same image are resized from
+          the largest fitted image they fit within instead of the full size
+          image.
+
+        Each branch of operations is transformed in turn unless a `submit`
+        function is given that schedules a call and returns a future for it
+        (e.g. `ThreadPoolExecutor.submit`), the branches are then transformed
+        concurrently and variations are yielded as they're produced.
+        """
 
-                # Add the optimize flag for JPEGs and PNGs
-                if fmt['format'] in ['jpeg', 'png']:
-                    fmt['optimize'] = True
+        # Build a tree of the operations for the variations, variations that
+        # share a common prefix of operations share the same branch.
+        tree = {'children': OrderedDict(), 'names': []}
+        formats = {}
+        for name, ops in variations.items():
+            node = tree
+            ops, fmt = Variation.compile_ops(ops, size or im.size)
+            if size:
+                ops = Variation.scale_ops(ops, size, im.size)
+
+            for op in ops:
+                key = json.dumps(op, sort_keys=True)
+                if key not in node['children']:
+                    node['children'][key] = {
+                        'op': op,
+                        'children': OrderedDict(),
+                        'names': []
+                        }
+                node = node['children'][key]
+
+            node['names'].append(name)
+            formats[name] = fmt
+
+        def transform(node, im, faces, op=None, resizes=()):
+            # Perform the operation for the branch (against the image produced
+            # by its parent).
+            if op:
+                next_faces = Variation.map_faces(faces, op, im)
+                im = Variation.apply_op(im, op, faces)
+                faces = next_faces
+
+            # Transform the variations that end at this node
+            transformed = []
+            for name in node['names']:
+                fmt = formats[name]
+                vim = Variation.web_safe_image(im, fmt)
+
+                # Images for variations may be saved concurrently so each
+                # variation must be given a separate image.
+                if vim is im:
+                    vim = im.copy()
+
+                transformed.append((name, vim, fmt))
+
+            # Find the branches to transform next, any fits and resizes grouped
+            # with this branch (see below) are resized from this image.
+            branches = [
+                (child, im, faces, ['resize', list(child_size)])
+                for child_size, child in resizes
+                ]
+
+            # Fits and resizes are grouped so that each group is resized from
+            # this image to the largest size in the group, and the others in
+            # the group are then resized from that image.
+            groups = []
+            for child in node['children'].values():
+                child_size = None
+                if child['op'][0] == 'fit':
+                    child_size = Variation.fit_size(im.size, child['op'][1])
+                elif child['op'][0] == 'resize':
+                    child_size = tuple(child['op'][1])
+
+                if child_size is None:
+                    branches.append((child, im, faces, child['op']))
+                else:
+                    groups.append((child_size, child))
+
+            groups.sort(key=lambda g: -(g[0][0] * g[0][1]))
+
+            grouped = []
+            for child_size, child in groups:
+                for group in grouped:
+                    group_size = group[0][0]
+                    if group_size[0] >= child_size[0] \
+                            and group_size[1] >= child_size[1]:
+                        group.append((child_size, child))
+                        break
+                else:
+                    grouped.append([(child_size, child)])
+
+            for group in grouped:
+                child_size, child = group[0]
+                branches.append(
+                    (child, im, faces, ['resize', list(child_size)], group[1:])
+                    )
+
+            return transformed, branches
+
+        # Transform each branch in turn (depth first)
+        if submit is None:
+            branches = [(tree, im, faces)]
+            while branches:
+                transformed, next_branches = transform(*branches.pop())
+                yield from transformed
+                branches.extend(reversed(next_branches))
+            return
 
-                # Allow gifs to store multiple frames
-                if fmt['format'] in ['gif', 'webp']:
-                    fmt['save_all'] = True
-                    fmt['optimize'] = True
+        # Transform the branches concurrently, submitting each branch once its
+        # parent has been transformed.
+        futures = {submit(transform, tree, im, faces)}
+        while futures:
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                transformed, branches = future.result()
+                yield from transformed
+                for branch in branches:
+                    futures.add(submit(transform, *branch))
 
-        # Variations are output in web safe colour modes, if the
-        # original image isn't using a web safe colour mode supported by
-        # the output format it will be converted to one.
+    @staticmethod
+    def web_safe_image(im, fmt):
+        """
+        Return a version of the image in a web safe colour mode supported by the
+        output format (if the image's mode isn't already supported).
+        """
         if fmt['format'] == 'gif' and im.mode != 'P':
             im = im.convert('P')
 
@@ -331,7 +828,7 @@ class Variation(SubFrame):
         elif fmt['format'] == 'webp' and im.mode != 'RGBA':
             im = im.convert('RGBA')
 
-        return im, fmt
+        return im
 
 
 class Asset(Frame):
@@ -350,10 +847,16 @@ class Asset(Frame):
         'expires',
         'meta',
         'store_key',
+        'blob_key',
         'variations'
         }
     _indexes = [
-        IndexModel([('account', ASC), ('uid', ASC)], unique=True)
+        IndexModel([('account', ASC), ('uid', ASC)], unique=True),
+        IndexModel([
+            ('account', ASC),
+            ('uid', ASC),
+            ('variations.ops_hash', ASC)
+            ])
     ]
 
     _private_fields = ['_id', 'account']
@@ -376,11 +879,32 @@ class Asset(Frame):
     def __str__(self):
         return self.store_key
 
+    @property
+    def backend_key(self):
+        """
+        Return the key the asset's file is stored under in the backend
+        (deduplicated assets are stored as blobs).
+        """
+        return self.blob_key or self.store_key
+
     @property
     def content_type(self):
         """Return a content type for the asset based on the extension"""
         return self.guess_content_type(self.store_key)
 
+    @property
+    def etag(self):
+        """
+        Return an ETag for the asset's file, the hash of the file's contents if
+        known, otherwise a hash of the asset's store key and modified date.
+        """
+        if (self.meta or {}).get('hash'):
+            return self.meta['hash']
+
+        modified = self.modified.isoformat() if self.modified else ''
+        etag = '{0}:{1}'.format(self.store_key, modified)
+        return hashlib.sha1(etag.encode('utf8')).hexdigest()
+
     @property
     def expired(self):
         if self.expires is None:
@@ -388,63 +912,365 @@ class Asset(Frame):
         now = time.mktime(datetime.now(timezone.utc).timetuple())
         return self.expires < now
 
-    def add_variation(self, f, im, name, ops):
+    def add_variation(self, f, im, name, ops, force=False):
         """Add a variation to the asset"""
+        return self.add_variations(f, im, {name: ops}, force)[name]
+
+    def add_variations(self, f, im, variations, force=False):
+        """
+        Add a set of variations (a dictionary of names and ops) to the asset and
+        return a dictionary of the new variations. Variations that already
+        exist with the same name and ops are returned rather than generated
+        again, unless `force` is True.
+
+        The variations' images are produced together (see
+        `Variation.transform_images`). The branches of operations shared by the
+        variations are transformed, and the variations saved and stored,
+        concurrently using a bounded pool of threads (see the
+        `VARIATION_WORKERS` setting), Pillow releases the GIL while resizing
+        and encoding images and storing variations is largely I/O.
+        """
         from models.accounts import Account
 
         # Make sure we have access to the associated account frame
         if not isinstance(self.account, Account):
             self.account = Account.one(Q._id == self.account)
 
-        # Transform the original image to generate the variation
-        vim = None
+        # Hash the ops for each variation so that the variation can be found
+        # by its ops (see `find_variation`).
+        ops_hashes = {
+            name: Variation.get_ops_hash(ops)
+            for name, ops in variations.items()
+            }
+
+        # Return existing variations with the same name and ops
+        new_variations = {}
+        if not force:
+            new_variations = self.find_variations(variations)
+
+        # Variations that have already been generated (and deduplicated) for
+        # the same original and ops reference the existing file rather than
+        # being generated again.
+        for name in variations:
+            if name in new_variations:
+                continue
+
+            blob_hash = self.get_variation_hash(ops_hashes[name])
+            blob = blob_hash and Blob.acquire(self.account, blob_hash)
+            if blob:
+                new_variations[name] = self.add_variation_blob(
+                    name,
+                    blob,
+                    ops_hashes[name],
+                    force
+                    )
+
+        variations = {
+            name: ops
+            for name, ops in variations.items()
+            if name not in new_variations
+            }
+        if not variations:
+            return new_variations
+
+        # If none of the variations require the full size image then JPEGs can
+        # be decoded at a reduced scale (1/2, 1/4 or 1/8).
+        size = im.size
+        if im.format == 'JPEG':
+            source_size = [0, 0]
+            for ops in variations.values():
+                ops_size = Variation.get_source_size(size, ops)
+                source_size[0] = max(source_size[0], ops_size[0])
+                source_size[1] = max(source_size[1], ops_size[1])
+
+            if tuple(source_size) != size:
+                im.draft(im.mode, tuple(source_size))
+
+        # Make sure the image is decoded before it's shared between threads
+        im.load()
+
+        # Faces are detected in the image once and stored against the asset,
+        # face operations then use the stored faces.
+        faces = (self.meta or {}).get('faces')
+        if faces is None and current_app.config['SUPPORT_FACE_DETECTION']:
+            for ops in variations.values():
+                if [op for op in ops if op[0] == 'face']:
+                    faces = self.detect_faces(im)
+                    break
+
+        # By-pass transforms for animated gifs
         if im.format.lower() == 'gif' and im.is_animated:
-            # By-pass transforms for animated gifs
             fmt = {'ext': 'gif', 'fmt': 'gif'}
+            for name in variations:
+                new_variations[name] = self.store_variation(
+                    name,
+                    im,
+                    fmt,
+                    f,
+                    ops_hashes[name],
+                    force
+                    )
+            return new_variations
+
+        # Transform the original image to generate the variations
+        workers = min(current_app.config['VARIATION_WORKERS'], len(variations))
+        if workers <= 1:
+            transformed = \
+                    Variation.transform_images(im, variations, faces, size)
+            for name, vim, fmt in transformed:
+                new_variations[name] = self.store_variation(
+                    name,
+                    vim,
+                    fmt,
+                    ops_hash=ops_hashes[name],
+                    force=force
+                    )
+            return new_variations
+
+        # Each thread must run within the application's context
+        app = current_app._get_current_object()
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+
+            def submit(fn, *args, **kwargs):
+                def call():
+                    with app.app_context():
+                        return fn(*args, **kwargs)
+                return executor.submit(call)
+
+            # Transform the images for the variations and store each variation
+            # as its image is produced.
+            transformed = Variation.transform_images(
+                im,
+                variations,
+                faces,
+                size,
+                submit
+                )
+            futures = {
+                name: submit(
+                    self.store_variation,
+                    name,
+                    vim,
+                    fmt,
+                    ops_hash=ops_hashes[name],
+                    force=force
+                    )
+                for name, vim, fmt in transformed
+                }
+            for name, future in futures.items():
+                new_variations[name] = future.result()
+
+        return new_variations
+
+    def store_variation(
+        self,
+        name,
+        im,
+        fmt,
+        f=None,
+        ops_hash=None,
+        force=False
+        ):
+        """
+        Store the image for a variation and add the variation to the asset. If
+        a file is given it's stored as is, otherwise the image is saved using
+        the given format (see `insert_variation` for `force`).
+        """
 
-        else:
-            # Transform the image based on the variation
-            vim = im.copy()
-            vim, fmt = Variation.transform_image(vim, ops)
-
-            # Prepare the variation file for storage
+        # Prepare the variation file for storage
+        if f is None:
             f = io.BytesIO()
-            vim.save(f, **fmt)
+            im.save(f, **fmt)
             f.seek(0)
 
         # Add the variation to the asset
         variation = Variation(
             name=name,
             ext=fmt['ext'],
+            ops_hash=ops_hash,
             meta={
                 'length': get_file_length(f),
                 'image': {
-                    'mode': (vim or im).mode,
-                    'size': (vim or im).size
+                    'mode': im.mode,
+                    'size': im.size
                     }
                 }
             )
 
+        # Deduplicated variations are stored as blobs shared by variations
+        # generated from the same original with the same ops.
+        blob_hash = self.get_variation_hash(ops_hash)
+        if blob_hash:
+            blob = Blob.store(
+                self.account,
+                blob_hash,
+                f,
+                variation.ext,
+                variation.meta
+                )
+            return self.add_variation_blob(name, blob, ops_hash, force)
+
+        return self.insert_variation(variation, f, force)
+
+    def add_variation_blob(self, name, blob, ops_hash, force=False):
+        """
+        Add a variation to the asset that references an existing blob (see
+        `insert_variation` for `force`).
+        """
+        variation = Variation(
+            name=name,
+            ext=blob.store_key.rsplit('.', 1)[1],
+            ops_hash=ops_hash,
+            meta=blob.meta,
+            blob_key=blob.store_key
+            )
+        return self.insert_variation(variation, force=force)
+
+    def insert_variation(self, variation, f=None, force=False):
+        """
+        Set a version and store key for a variation and add it to the asset. If
+        a file is given it's stored as the variation's file.
+
+        Unless `force` is True, if a variation with the same name and ops has
+        been added to the asset (by another process) in the meantime the
+        variation is discarded and the existing variation returned.
+        """
+
         # Set a version
         variation.version = generate_uid(3)
-        while self.get_variation(name, variation.version):
+        while self.get_variation(variation.name, variation.version):
             variation.version = generate_uid(3)
 
         # Store the variation
         variation.store_key = Variation.get_store_key(self, variation)
-        backend = self.account.get_backend_instance()
-        backend.store(f, variation.store_key)
+        if f is not None:
+            backend = self.account.get_backend_instance()
+            backend.store(f, variation.store_key)
 
         # We use the $push operator to store the variation to prevent race
         # conditions if multiple processes attempt to update the assets
         # variations at the same time.
-        self.get_collection().update(
-            {'_id': self._id},
+        query = {'_id': self._id}
+        if not force and variation.ops_hash:
+            query['variations'] = {
+                '$not': {
+                    '$elemMatch': {
+                        'name': variation.name,
+                        'ops_hash': variation.ops_hash
+                    }
+                }
+            }
+
+        result = self.get_collection().update_one(
+            query,
             {'$push': {'variations': variation._document}}
         )
+        if result.matched_count:
+            return variation
+
+        # Another process added the same variation first, discard ours
+        if variation.blob_key:
+            Blob.release(self.account, variation.blob_key)
+        elif f is not None:
+            backend.delete(variation.store_key)
+
+        asset = Asset.by_id(self._id)
+        if asset:
+            self.variations = asset.variations
+            existing = self.find_variation(variation.ops_hash, variation.name)
+            if existing:
+                return existing
 
         return variation
 
+    def detect_faces(self, im):
+        """
+        Detect the faces in the asset's image, store them against the asset
+        (`meta.faces`) and return them. Faces are stored as rectangles
+        normalized to the size of the image (e.g. `[0.1, 0.2, 0.3, 0.4]`).
+        """
+        w, h = im.size
+        faces = [
+            [l / w, t / h, r / w, b / h]
+            for l, t, r, b in Variation.detect_faces(im)
+            ]
+
+        if self.meta is None:
+            self.meta = {}
+        self.meta['faces'] = faces
+
+        # If the asset has already been inserted update the stored faces
+        if self._id:
+            self.get_collection().update(
+                {'_id': self._id},
+                {'$set': {'meta.faces': faces}}
+                )
+
+        return faces
+
+    def fetch_variation(self, ops_hash):
+        """
+        Return a variation generated from ops with the given hash. Unlike
+        `find_variation` the variation is looked up in the database (using the
+        `variations.ops_hash` index) so the asset's variations don't need to
+        be loaded, if there's more than one matching variation the first is
+        returned.
+        """
+        document = self.get_collection().find_one(
+            to_refs({
+                'account': self.account,
+                'uid': self.uid,
+                'variations.ops_hash': ops_hash
+                }),
+            projection={'variations.$': True}
+            )
+        if document and document.get('variations'):
+            return Variation(document['variations'][0])
+
+    def find_variation(self, ops_hash, name=None):
+        """
+        Return a variation generated from ops with the given hash (and
+        optionally with the given name), if there's more than one matching
+        variation the most recent is returned.
+        """
+        if not self.variations:
+            return
+
+        # Attempt to find the variation
+        for variation in reversed(self.variations):
+            if variation.ops_hash != ops_hash:
+                continue
+
+            if name is None or variation.name == name:
+                return variation
+
+    def find_variations(self, variations):
+        """
+        Return a dictionary of the existing variations for a set of variations
+        (a dictionary of names and ops) with the same name and ops.
+        """
+        existing_variations = {}
+        for name, ops in variations.items():
+            variation = self.find_variation(Variation.get_ops_hash(ops), name)
+            if variation:
+                existing_variations[name] = variation
+
+        return existing_variations
+
+    def get_variation_hash(self, ops_hash):
+        """
+        Return the hash used to deduplicate variations of the asset generated
+        from ops with the given hash, or `None` if the variations aren't
+        deduplicated.
+        """
+        asset_hash = (self.meta or {}).get('hash')
+        if not (current_app.config['DEDUPLICATE_ASSETS'] and asset_hash):
+            return None
+
+        variation_hash = '{0}:{1}'.format(asset_hash, ops_hash)
+        return hashlib.sha256(variation_hash.encode('utf8')).hexdigest()
+
     def get_variation(self, name, version):
         """Return a variation with the given name and version"""
         if not self.variations:
@@ -466,12 +1292,19 @@ class Asset(Frame):
         # Get the backend required to delete the asset
         backend = self.account.get_backend_instance()
 
-        # Delete the original file
-        backend.delete(self.store_key)
+        # Delete the original file (deduplicated files are only deleted once
+        # they're no longer referenced).
+        if self.blob_key:
+            Blob.release(self.account, self.blob_key)
+        else:
+            backend.delete(self.store_key)
 
         # Delete all variation files
         for variation in self.variations:
-            backend.delete(variation.store_key)
+            if variation.blob_key:
+                Blob.release(self.account, variation.blob_key)
+            else:
+                backend.delete(variation.store_key)
 
         self.delete()
 
@@ -0,0 +1,137 @@
+from datetime import datetime, timezone
+from mongoframes import *
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from utils import generate_uid
+
+__all__ = ['Blob']
+
+
+class Blob(Frame):
+    """
+    A file stored once for an account and shared (by reference) between any
+    number of assets and variations with the same content (see the
+    `DEDUPLICATE_ASSETS` setting).
+
+    Blobs are identified by a hash (per account) and count the references held
+    to them, the blob and its file are deleted when the last reference is
+    released.
+    """
+
+    _fields = {
+        'created',
+        'modified',
+        'account',
+        'hash',
+        'store_key',
+        'meta',
+        'refs'
+        }
+    _indexes = [
+        IndexModel([('account', ASC), ('hash', ASC)], unique=True),
+        IndexModel([('account', ASC), ('store_key', ASC)])
+    ]
+
+    def __str__(self):
+        return self.store_key
+
+    @classmethod
+    def acquire(cls, account, hash):
+        """
+        Return the blob with the given hash adding a reference to it, or `None`
+        if there's no matching blob.
+        """
+        document = cls.get_collection().find_one_and_update(
+            {'account': account._id, 'hash': hash, 'refs': {'$gt': 0}},
+            {
+                '$inc': {'refs': 1},
+                '$set': {'modified': datetime.now(timezone.utc)}
+            },
+            return_document=ReturnDocument.AFTER
+            )
+        if document:
+            return cls(document)
+
+    @classmethod
+    def release(cls, account, store_key):
+        """
+        Release a reference to the blob stored with the given key, if it's the
+        last reference the blob and its file are deleted.
+        """
+        collection = cls.get_collection()
+        document = collection.find_one_and_update(
+            {'account': account._id, 'store_key': store_key},
+            {
+                '$inc': {'refs': -1},
+                '$set': {'modified': datetime.now(timezone.utc)}
+            },
+            return_document=ReturnDocument.AFTER
+            )
+        if not document or document['refs'] > 0:
+            return
+
+        # Only delete the file if the blob hasn't been referenced again in the
+        # meantime.
+        result = collection.delete_one(
+            {'_id': document['_id'], 'refs': {'$lte': 0}}
+            )
+        if result.deleted_count:
+            account.get_backend_instance().delete(store_key)
+
+    @classmethod
+    def store(cls, account, hash, f, ext, meta=None):
+        """
+        Return the blob for a file with the given hash, storing the file if
+        there's no existing blob. A reference is added to the blob returned.
+        """
+
+        # Check for an existing blob
+        blob = cls.acquire(account, hash)
+        if blob:
+            return blob
+
+        # Store the file
+        store_key = cls.get_store_key(hash, ext)
+        backend = account.get_backend_instance()
+        backend.store(f, store_key)
+
+        # Add the blob, if a blob with the same hash was added while we were
+        # storing the file then we reference that blob and remove our file.
+        while True:
+            now = datetime.now(timezone.utc)
+            try:
+                document = cls.get_collection().find_one_and_update(
+                    {'account': account._id, 'hash': hash},
+                    {
+                        '$inc': {'refs': 1},
+                        '$set': {'modified': now},
+                        '$setOnInsert': {
+                            'created': now,
+                            'store_key': store_key,
+                            'meta': meta or {}
+                        }
+                    },
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER
+                    )
+                break
+
+            except DuplicateKeyError:
+                # Concurrent upserts for the same hash can both attempt the
+                # insert, the loser references the blob the winner added (if
+                # it's since been released we try the upsert again).
+                blob = cls.acquire(account, hash)
+                if blob:
+                    backend.delete(store_key)
+                    return blob
+
+        if document['store_key'] != store_key:
+            backend.delete(store_key)
+
+        return cls(document)
+
+    @staticmethod
+    def get_store_key(hash, ext):
+        """Return a store key for a blob"""
+        return '.'.join(['blobs/' + hash, generate_uid(6), ext])
\ No newline at end of file
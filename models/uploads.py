@@ -0,0 +1,73 @@
+from datetime import datetime, timezone
+from mongoframes import *
+import time
+
+__all__ = ['Upload']
+
+
+class Upload(Frame):
+    """
+    A reservation for a file to be uploaded directly to an account's backend
+    (rather than through the application). Once the file has been uploaded the
+    reservation is completed and becomes an asset, reservations that aren't
+    completed before they expire are purged along with any file uploaded.
+    """
+
+    _fields = {
+        'created',
+        'modified',
+        'account',
+        'uid',
+        'name',
+        'ext',
+        'filename',
+        'store_key',
+        'expires',
+        'asset_expires'
+        }
+    _indexes = [
+        IndexModel([('account', ASC), ('uid', ASC)], unique=True),
+        IndexModel([('expires', ASC)])
+    ]
+
+    def __str__(self):
+        return self.store_key
+
+    @property
+    def expired(self):
+        now = time.mktime(datetime.now(timezone.utc).timetuple())
+        return self.expires < now
+
+    def claim(self):
+        """
+        Claim the reservation (deleting it), returns `False` if the reservation
+        has already been claimed (completed or purged).
+        """
+        result = self.get_collection().delete_one({'_id': self._id})
+        return result.deleted_count > 0
+
+    def purge(self):
+        """Deletes the reservation along with any file uploaded."""
+        from models.accounts import Account
+        from models.assets import Asset
+
+        # Make sure the reservation hasn't been completed in the meantime
+        if not self.claim():
+            return
+
+        # Don't delete the file if an asset was created for it (but the
+        # reservation wasn't claimed).
+        if Asset.count(And(Q.account == self.account, Q.uid == self.uid)):
+            return
+
+        # Delete any file uploaded
+        account = self.account
+        if not isinstance(account, Account):
+            account = Account.one(Q._id == account)
+
+        if account:
+            account.get_backend_instance().delete(self.store_key)
+
+
+Upload.listen('insert', Upload.timestamp_insert)
+Upload.listen('update', Upload.timestamp_update)
\ No newline at end of file
@@ -2,6 +2,21 @@ from datetime import timedelta
 
 class DefaultConfig:
 
+    # Accounts
+    #
+    # Accounts are cached by API key in each process. Changes made to accounts
+    # by other processes (e.g. management commands) are checked for every
+    # `ACCOUNT_CACHE_CHECK_INTERVAL` seconds.
+    ACCOUNT_CACHE_SIZE = 1000
+    ACCOUNT_CACHE_TTL = 300
+    ACCOUNT_CACHE_CHECK_INTERVAL = 5
+
+    # Backends
+    #
+    # The maximum number of backend instances (one per account) each process
+    # keeps open for reuse across requests.
+    BACKEND_CACHE_SIZE = 100
+
     # Database
     MONGO_URI = 'mongodb://localhost:27017/hangar51'
     MONGO_USERNAME = 'hangar51'
@@ -11,18 +26,101 @@ class DefaultConfig:
     DEBUG = False
     SENTRY_DSN = ''
 
+    # Deduplication
+    #
+    # If enabled, uploaded files (and the variations generated from them) are
+    # hashed and files with the same content are only stored once per account.
+    DEDUPLICATE_ASSETS = False
+
+    # Downloads
+    #
+    # The mode used to serve files held on the local file system:
+    #
+    # - `stream` files are streamed through the application.
+    # - `accel` files are served by nginx using an `X-Accel-Redirect` header,
+    #   the prefix must match an `internal` location in the nginx config that
+    #   aliases the `DOWNLOAD_ACCEL_ROOT` directory (files outside of the
+    #   directory are streamed).
+    # - `sendfile` files are served by the WSGI server (`wsgi.file_wrapper`).
+    #
+    DOWNLOAD_MODE = 'stream'
+    DOWNLOAD_ACCEL_PREFIX = '/_internal_assets'
+    DOWNLOAD_ACCEL_ROOT = ''
+
+    # The maximum time (in seconds) downloaded files can be cached for
+    DOWNLOAD_CACHE_MAX_AGE = 365 * 24 * 60 * 60
+
     # Networking
     PREFERRED_URL_SCHEME = 'http'
     SERVER_NAME = ''
 
+    # S3
+    #
+    # Files of `S3_MULTIPART_THRESHOLD` bytes or more are stored using
+    # multipart uploads, up to `S3_MULTIPART_CONCURRENCY` parts (of
+    # `S3_MULTIPART_PART_SIZE` bytes, min. 5MB) are uploaded at once and each
+    # part is retried up to `S3_MULTIPART_RETRIES` times.
+    S3_MULTIPART_THRESHOLD = 16 * 1024 * 1024
+    S3_MULTIPART_PART_SIZE = 8 * 1024 * 1024
+    S3_MULTIPART_CONCURRENCY = 4
+    S3_MULTIPART_RETRIES = 3
+
     # Tasks (background)
     CELERY_BROKER_URL = ''
     CELERYBEAT_SCHEDULE = {
         'purge_expired_assets': {
             'task': 'purge_expired_assets',
             'schedule': timedelta(seconds=3600)
+        },
+        'purge_expired_uploads': {
+            'task': 'purge_expired_uploads',
+            'schedule': timedelta(seconds=3600)
         }
     }
 
+    # Uploads
+    #
+    # Uploaded files are held in memory up to `UPLOAD_SPOOL_SIZE` bytes, larger
+    # files are spooled to disk.
+    UPLOAD_SPOOL_SIZE = 1024 * 1024
+
+    # Files can be uploaded directly to an account's backend (see
+    # `upload-reserve`), reservations expire after `UPLOAD_RESERVE_EXPIRES`
+    # seconds and files uploaded directly can be at most `UPLOAD_MAX_LENGTH`
+    # bytes (S3 limits POST uploads to 5GB).
+    UPLOAD_RESERVE_EXPIRES = 60 * 60
+    UPLOAD_MAX_LENGTH = 5 * 1024 * 1024 * 1024
+
+    # Variations
+    #
+    # The maximum number of threads used to generate the variations for an
+    # asset concurrently (1 generates variations in serial). The threads
+    # transform the branches of operations shared by the variations (see
+    # `Variation.transform_images`) and save and store each variation.
+    VARIATION_WORKERS = 4
+
     # Additional variation support
-    SUPPORT_FACE_DETECTION = False
\ No newline at end of file
+    SUPPORT_FACE_DETECTION = False
+
+    # Face detection
+    #
+    # Images are scaled to fit within `FACE_DETECTION_SIZE` pixels before
+    # faces are detected, upsampling the image (`FACE_DETECTION_UPSAMPLE`)
+    # allows smaller faces to be detected at the cost of speed.
+    FACE_DETECTION_SIZE = 1000
+    FACE_DETECTION_UPSAMPLE = 1
+
+    # Faces detected in an image are stored against the asset. By default faces
+    # are detected the first time a variation with a face operation is
+    # generated, alternatively faces can be detected when images are uploaded
+    # (`wait`) or in the background after they're uploaded (`background`).
+    FACE_DETECTION_ON_UPLOAD = ''
+
+    # Faces can be detected by a pool of `FACE_DETECTION_PROCESSES` processes
+    # (started with the application) rather than in the process handling the
+    # request/task (0). At most `FACE_DETECTION_QUEUE_SIZE` images are queued
+    # for the pool, callers wait up to `FACE_DETECTION_TIMEOUT` seconds for
+    # space in the queue and again for faces to be detected.
+    FACE_DETECTION_PROCESSES = 0
+    FACE_DETECTION_QUEUE_SIZE = 8
+    FACE_DETECTION_TIMEOUT = 30
\ No newline at end of file
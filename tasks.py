@@ -1,6 +1,8 @@
 import argparse
 from celery import Celery
 from datetime import datetime, timezone
+from flask import current_app
+import hashlib
 import json
 from mongoframes import *
 from PIL import Image
@@ -10,6 +12,8 @@ import time
 from app import create_app
 from models.accounts import Account
 from models.assets import Asset, Variation
+from models.uploads import Upload
+from utils.faces import FaceDetectionPoolBusy
 
 __all__ = ['setup_tasks']
 
@@ -17,8 +21,46 @@ __all__ = ['setup_tasks']
 # Define the tasks for the application
 def setup_tasks(celery):
 
-    @celery.task(name='generate_variations')
-    def generate_variations(account_id, asset_uid, variations, webhook=''):
+    @celery.task(name='detect_faces', bind=True)
+    def detect_faces(self, account_id, asset_uid):
+        """Detect (and store) the faces in an image asset"""
+
+        # Find the account
+        account = Account.by_id(account_id)
+        if not account:
+            return
+
+        # Find the asset
+        asset = Asset.one(And(Q.account == account, Q.uid == asset_uid))
+        if not asset:
+            return
+
+        # Check the asset hasn't expired or already had faces detected
+        if asset.expired or 'faces' in (asset.meta or {}):
+            return
+
+        # Retrieve the original file
+        backend = account.get_backend_instance()
+        f = backend.retrieve(asset.backend_key)
+
+        # Detect the faces (retrying later if face detection is busy)
+        try:
+            asset.detect_faces(Image.open(f))
+        except FaceDetectionPoolBusy as e:
+            raise self.retry(
+                exc=e,
+                countdown=current_app.config['FACE_DETECTION_TIMEOUT']
+                )
+
+    @celery.task(name='generate_variations', bind=True)
+    def generate_variations(
+        self,
+        account_id,
+        asset_uid,
+        variations,
+        webhook='',
+        force=False
+        ):
         """Generate a set of variations for an image asset"""
 
         # Find the account
@@ -35,19 +77,27 @@ def setup_tasks(celery):
         if asset.expired:
             return
 
-        # Retrieve the original file
-        backend = account.get_backend_instance()
-        f = backend.retrieve(asset.store_key)
-        im = Image.open(f)
+        # Generate the variations (unless they already exist with the same
+        # names and ops).
+        if force or len(asset.find_variations(variations)) < len(variations):
+
+            # Retrieve the original file
+            backend = account.get_backend_instance()
+            f = backend.retrieve(asset.backend_key)
+            im = Image.open(f)
 
-        # Generate the variations
-        new_variations = {}
-        for name, ops in variations.items():
-            variation = asset.add_variation(im, name, ops)
-            new_variations[name] = variation.to_json_type()
+            # Generate the variations (retrying later if face detection is
+            # busy).
+            try:
+                asset.add_variations(f, im, variations, force)
+            except FaceDetectionPoolBusy as e:
+                raise self.retry(
+                    exc=e,
+                    countdown=current_app.config['FACE_DETECTION_TIMEOUT']
+                    )
 
-        # Update the assets modified timestamp
-        asset.update('modified')
+            # Update the assets modified timestamp
+            asset.update('modified')
 
         # If a webhook has been provide call it with details of the new
         # variations.
@@ -61,6 +111,40 @@ def setup_tasks(celery):
                     }
                 )
 
+    @celery.task(name='prep_asset')
+    def prep_asset(account_id, asset_uid):
+        """
+        Prepare a file uploaded directly to the account's backend, as if it had
+        been uploaded through the application the file is hashed (images are
+        prepared when the upload is completed).
+        """
+
+        # Find the account
+        account = Account.by_id(account_id)
+        if not account:
+            return
+
+        # Find the asset
+        asset = Asset.one(And(Q.account == account, Q.uid == asset_uid))
+        if not asset:
+            return
+
+        # Check the asset hasn't expired or already been prepared
+        if asset.expired or not (asset.meta or {}).get('pending'):
+            return
+
+        # Hash the file a chunk at a time (files may be too large to hold in
+        # memory).
+        backend = account.get_backend_instance()
+        file_hash = hashlib.sha256()
+        for chunk in backend.stream(asset.store_key):
+            file_hash.update(chunk)
+
+        # Allow the asset to be downloaded
+        asset.meta['hash'] = file_hash.hexdigest()
+        asset.meta.pop('pending')
+        asset.update('modified', 'meta')
+
     @celery.task(name='purge_expired_assets')
     def purge_expired_assets():
         """Purge assets which have expired"""
@@ -74,4 +158,19 @@ def setup_tasks(celery):
 
         # Purge each asset
         for asset in assets:
-            asset.purge()
\ No newline at end of file
+            asset.purge()
+
+    @celery.task(name='purge_expired_uploads')
+    def purge_expired_uploads():
+        """
+        Purge upload reservations (and any files uploaded) which have expired
+        without being completed.
+        """
+
+        # Get any upload that has expired
+        now = time.mktime(datetime.now(timezone.utc).timetuple())
+        uploads = Upload.many(Q.expires <= now)
+
+        # Purge each upload
+        for upload in uploads:
+            upload.purge()
\ No newline at end of file
@@ -1,12 +1,16 @@
 from datetime import datetime, timedelta, timezone
-from flask import current_app, g, url_for
+from flask import current_app, url_for
 import io
 import json
 from mongoframes import *
+import os
 import time
+from unittest import mock
 
-from models.accounts import Account
-from models.assets import Asset
+from backends.local import LocalBackend
+from models.assets import Asset, Variation
+from models.blobs import Blob
+from models.uploads import Upload
 from tests import *
 
 
@@ -158,7 +162,7 @@ def test_generate_variations(client, test_backends, test_images):
         assert payload['test1']['store_key'] == key
         assert payload['test1']['meta']['image'] == {
             'mode': 'RGB',
-            'size': [200, 150]
+            'size': [100, 75]
             }
 
         # Test variation 2
@@ -172,9 +176,42 @@ def test_generate_variations(client, test_backends, test_images):
         assert payload['test2']['store_key'] == key
         assert payload['test2']['meta']['image'] == {
             'mode': 'RGBA',
-            'size': [100, 75]
+            'size': [50, 37]
             }
 
+def test_generate_variations_existing(
+    client,
+    test_local_account,
+    test_local_assets
+    ):
+    account = test_local_account
+    asset = Asset.one(Q.name == 'image')
+    variations = {'test1': [['fit', [200, 200]], ['rotate', 0]]}
+
+    # Generate the same variation three times (the last time forcing the
+    # variation to be generated again).
+    versions = []
+    for force in ['', '', 'y']:
+        response = client.post(
+            url_for('api.generate_variations'),
+            data=dict(
+                api_key=account.api_key,
+                uid=asset.uid,
+                variations=json.dumps(variations),
+                on_delivery='wait',
+                force=force
+                )
+            )
+        assert response.json['status'] == 'success'
+        versions.append(response.json['payload']['test1']['version'])
+
+    # Check the existing variation was returned unless forced
+    assert versions[0] == versions[1]
+    assert versions[1] != versions[2]
+
+    asset = Asset.by_id(asset._id)
+    assert len([v for v in asset.variations if v.name == 'test1']) == 2
+
 def test_get(client, test_local_account, test_local_assets):
     account = test_local_account
 
@@ -263,6 +300,165 @@ def test_download(client, test_local_account, test_local_assets):
     assert response.headers['Content-Disposition'] == content_disposition
     assert len(response.data) == file_asset.meta['length']
 
+def test_download_range(client, test_local_account, test_local_assets):
+    account = test_local_account
+
+    # Find an asset to download
+    file_asset = Asset.one(Q.name == 'file')
+    length = file_asset.meta['length']
+    backend = account.get_backend_instance()
+    data = backend.retrieve(file_asset.store_key).read()
+
+    # Download a range of the file
+    response = client.get(
+        url_for('api.download'),
+        data=dict(api_key=account.api_key, uid=file_asset.uid),
+        headers={'Range': 'bytes=10-19'}
+        )
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == \
+            'bytes 10-19/{0}'.format(length)
+    assert response.data == data[10:20]
+
+    # Download a range beyond the end of the file
+    response = client.get(
+        url_for('api.download'),
+        data=dict(api_key=account.api_key, uid=file_asset.uid),
+        headers={'Range': 'bytes={0}-'.format(length)}
+        )
+    assert response.status_code == 416
+
+    # Download a range of the file if it's unchanged (it's changed)
+    response = client.get(
+        url_for('api.download'),
+        data=dict(api_key=account.api_key, uid=file_asset.uid),
+        headers={
+            'Range': 'bytes=10-19',
+            'If-Range': 'Thu, 01 Jan 1970 00:00:00 GMT'
+            }
+        )
+    assert response.status_code == 200
+    assert response.data == data
+
+def test_download_conditional(client, test_local_account, test_local_assets):
+    account = test_local_account
+
+    # Find an asset to download
+    file_asset = Asset.one(Q.name == 'file')
+
+    # Download the file
+    response = client.get(
+        url_for('api.download'),
+        data=dict(api_key=account.api_key, uid=file_asset.uid)
+        )
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+    assert etag == '"{0}"'.format(file_asset.etag)
+    assert 'max-age' in response.headers['Cache-Control']
+
+    # Download the file again if it's changed (it's unchanged)
+    response = client.get(
+        url_for('api.download'),
+        data=dict(api_key=account.api_key, uid=file_asset.uid),
+        headers={'If-None-Match': etag}
+        )
+    assert response.status_code == 304
+    assert response.data == b''
+
+    # Download the file again if it's changed (it's changed)
+    response = client.get(
+        url_for('api.download'),
+        data=dict(api_key=account.api_key, uid=file_asset.uid),
+        headers={'If-None-Match': '"changed"'}
+        )
+    assert response.status_code == 200
+
+    # Get the asset's details again if they've changed (they're unchanged)
+    response = client.get(
+        url_for('api.get'),
+        data=dict(api_key=account.api_key, uid=file_asset.uid)
+        )
+    assert response.status_code == 200
+
+    response = client.get(
+        url_for('api.get'),
+        data=dict(api_key=account.api_key, uid=file_asset.uid),
+        headers={'If-None-Match': response.headers['ETag']}
+        )
+    assert response.status_code == 304
+
+def test_download_accel(client, test_local_account, test_local_assets):
+    account = test_local_account
+
+    # Find an asset to download
+    file_asset = Asset.one(Q.name == 'file')
+
+    # Download the file letting nginx serve it
+    current_app.config['DOWNLOAD_MODE'] = 'accel'
+    current_app.config['DOWNLOAD_ACCEL_ROOT'] = account.backend['asset_root']
+    try:
+        response = client.get(
+            url_for('api.download'),
+            data=dict(
+                api_key=account.api_key,
+                uid=file_asset.uid
+                )
+            )
+    finally:
+        current_app.config['DOWNLOAD_MODE'] = 'stream'
+        current_app.config['DOWNLOAD_ACCEL_ROOT'] = ''
+
+    # Check the file is handed off to nginx rather than sent
+    assert response.headers['X-Accel-Redirect'] == \
+            '/_internal_assets/' + file_asset.store_key
+    assert response.content_type == 'application/zip'
+    assert len(response.data) == 0
+
+    # Check files outside of the directory nginx serves files from are
+    # streamed.
+    current_app.config['DOWNLOAD_MODE'] = 'accel'
+    current_app.config['DOWNLOAD_ACCEL_ROOT'] = 'tests/data/other'
+    try:
+        response = client.get(
+            url_for('api.download'),
+            data=dict(
+                api_key=account.api_key,
+                uid=file_asset.uid
+                )
+            )
+    finally:
+        current_app.config['DOWNLOAD_MODE'] = 'stream'
+        current_app.config['DOWNLOAD_ACCEL_ROOT'] = ''
+
+    assert 'X-Accel-Redirect' not in response.headers
+    assert len(response.data) == file_asset.meta['length']
+
+def test_download_url(client, test_local_account, test_local_assets):
+    account = test_local_account
+
+    # Find an asset to download
+    file_asset = Asset.one(Q.name == 'file')
+
+    # Download the file from a backend that supports direct downloads
+    url = 'https://example.com/' + file_asset.store_key
+    with mock.patch.object(LocalBackend, 'get_download_url', return_value=url):
+        response = client.get(
+            url_for('api.download'),
+            data=dict(api_key=account.api_key, uid=file_asset.uid)
+            )
+
+        # Check the client is redirected to the backend
+        assert response.status_code == 302
+        assert response.headers['Location'] == url
+        assert response.headers['Cache-Control'] == 'no-store'
+
+        # Check the URL is included in the asset's details
+        response = client.get(
+            url_for('api.get'),
+            data=dict(api_key=account.api_key, uid=file_asset.uid)
+            )
+        assert response.json['payload']['url'] == url
+
 def test_set_expires(client, test_local_account):
     account = test_local_account
 
@@ -435,3 +631,219 @@ def test_upload_image_without_ext(client, test_local_account):
     assert payload['type'] == 'image'
     assert payload.get('uid') is not None
     assert payload['store_key'] == 'images/test.' + payload['uid'] + '.png'
+
+def test_upload_direct(client, test_local_account):
+    account = test_local_account
+
+    # Load a file to upload
+    with open('tests/data/assets/uploads/file.zip', 'rb') as f:
+        data = f.read()
+
+    # Reserve an upload
+    response = client.post(
+        url_for('api.upload_reserve'),
+        data=dict(api_key=account.api_key, filename='file.zip')
+        )
+    assert response.json['status'] == 'success'
+
+    # Check the upload was reserved (local backends don't support direct
+    # uploads so the file is sent via the application).
+    payload = response.json['payload']
+    upload = Upload.one(Q.uid == payload['uid'])
+    assert upload.store_key == 'file.' + upload.uid + '.zip'
+    assert payload['upload']['method'] == 'PUT'
+
+    # Check an upload can't be completed before the file is uploaded
+    response = client.post(
+        url_for('api.upload_complete'),
+        data=dict(api_key=account.api_key, uid=upload.uid)
+        )
+    assert response.json['status'] == 'fail'
+
+    # Upload the file
+    response = client.put(payload['upload']['url'], data=data)
+    assert response.json['status'] == 'success'
+
+    # Check the file can't be replaced
+    response = client.put(payload['upload']['url'], data=b'replaced')
+    assert response.json['status'] == 'fail'
+
+    # Check the upload is rejected with an invalid signature
+    response = client.put(
+        url_for(
+            'api.upload_direct',
+            account=account.name,
+            uid=upload.uid,
+            sig='invalid'
+            ),
+        data=data
+        )
+    assert response.json['status'] == 'fail'
+
+    # Complete the upload
+    with mock.patch.object(current_app.celery, 'send_task') as send_task:
+        response = client.post(
+            url_for('api.upload_complete'),
+            data=dict(api_key=account.api_key, uid=upload.uid)
+            )
+    assert response.json['status'] == 'success'
+
+    # Check the asset was created and is prepared in the background
+    asset = Asset.one(Q.uid == upload.uid)
+    assert asset.store_key == upload.store_key
+    assert asset.meta['length'] == len(data)
+    assert asset.meta['pending']
+    assert Upload.count() == 0
+    send_task.assert_called_once_with('prep_asset', [account._id, asset.uid])
+
+    # Check the asset can't be downloaded until it's been prepared
+    response = client.get(
+        url_for('api.download'),
+        data=dict(api_key=account.api_key, uid=asset.uid)
+        )
+    assert response.json['status'] == 'fail'
+
+def test_upload_direct_image(client, test_local_account):
+    account = test_local_account
+
+    # Load an image to upload
+    with open('tests/data/assets/uploads/image.jpg', 'rb') as f:
+        data = f.read()
+
+    # Reserve an upload and upload the image
+    response = client.post(
+        url_for('api.upload_reserve'),
+        data=dict(api_key=account.api_key, filename='image.jpg')
+        )
+    payload = response.json['payload']
+
+    response = client.put(payload['upload']['url'], data=data)
+    assert response.json['status'] == 'success'
+
+    # Complete the upload
+    with mock.patch.object(current_app.celery, 'send_task') as send_task:
+        response = client.post(
+            url_for('api.upload_complete'),
+            data=dict(api_key=account.api_key, uid=payload['uid'])
+            )
+    assert response.json['status'] == 'success'
+
+    # Check the image was prepared before the asset was created
+    asset = Asset.one(Q.uid == payload['uid'])
+    assert asset.type == 'image'
+    assert asset.meta['image']['size'] == [720, 960]
+    assert asset.meta.get('hash')
+    assert 'pending' not in asset.meta
+    assert send_task.call_count == 0
+
+def test_variation(client, test_local_account, test_local_assets):
+    account = test_local_account
+
+    # Find an image asset to serve a variation of
+    asset = Asset.one(Q.name == 'image')
+    ops = json.dumps([['fit', [100, 100]], ['output', {'format': 'png'}]])
+
+    # Check requests with an invalid signature are rejected
+    response = client.get(
+        url_for('api.variation'),
+        query_string=dict(
+            account=account.name,
+            uid=asset.uid,
+            ops=ops,
+            sig=account.sign(asset.uid + ':[]')
+            )
+        )
+    assert response.json['status'] == 'fail'
+
+    # Request the variation (twice) and check the variation is generated on
+    # the first request and then served.
+    for i in range(2):
+        response = client.get(
+            url_for('api.variation'),
+            query_string=dict(
+                account=account.name,
+                uid=asset.uid,
+                ops=ops,
+                sig=account.sign(asset.uid + ':' + ops)
+                )
+            )
+        assert response.content_type == 'image/png'
+
+        asset = Asset.by_id(asset._id)
+        assert len(asset.variations) == 2
+
+    # Check the variation served is the one stored
+    variation = asset.find_variation(Variation.get_ops_hash(json.loads(ops)))
+    assert variation.meta['image']['size'] == [75, 100]
+    assert len(response.data) == variation.meta['length']
+    assert asset.fetch_variation(variation.ops_hash).version == \
+            variation.version
+
+    # Request the variation as if it was generated by another request at the
+    # same time (both requests miss the stored variation).
+    with mock.patch.object(Asset, 'fetch_variation', return_value=None):
+        response = client.get(
+            url_for('api.variation'),
+            query_string=dict(
+                account=account.name,
+                uid=asset.uid,
+                ops=ops,
+                sig=account.sign(asset.uid + ':' + ops)
+                )
+            )
+    assert len(response.data) == variation.meta['length']
+
+    # Check the variation generated was discarded (along with its file)
+    asset = Asset.by_id(asset._id)
+    assert len(asset.variations) == 2
+
+    backend = account.get_backend_instance()
+    prefix = 'image.{0}.{1}.'.format(asset.uid, variation.ops_hash)
+    filenames = os.listdir(backend.asset_root)
+    assert len([f for f in filenames if f.startswith(prefix)]) == 1
+
+def test_upload_deduplicated(client, test_local_account):
+    account = test_local_account
+    backend = account.get_backend_instance()
+
+    # Upload the same file twice with deduplication enabled
+    current_app.config['DEDUPLICATE_ASSETS'] = True
+    try:
+        uids = []
+        for i in range(2):
+            with open('tests/data/assets/uploads/file.zip', 'rb') as f:
+                file_stream = io.BytesIO(f.read())
+
+            response = client.post(
+                url_for('api.upload'),
+                data=dict(
+                    api_key=account.api_key,
+                    asset=(file_stream, 'file.zip'),
+                    name='files/test'
+                    )
+                )
+            assert response.json['status'] == 'success'
+            uids.append(response.json['payload']['uid'])
+
+    finally:
+        current_app.config['DEDUPLICATE_ASSETS'] = False
+
+    # Check both assets share a single blob
+    assets = [Asset.one(Q.uid == uid) for uid in uids]
+    assert assets[0].store_key != assets[1].store_key
+    assert assets[0].blob_key == assets[1].blob_key
+
+    blob = Blob.one(Q.store_key == assets[0].blob_key)
+    assert blob.refs == 2
+    assert blob.hash == assets[0].meta['hash']
+
+    # Check the blob's file is only deleted once both assets are purged
+    local_path = backend.get_local_path(blob.store_key)
+
+    assets[0].purge()
+    assert Blob.by_id(blob._id).refs == 1
+    assert os.path.exists(local_path)
+
+    assets[1].purge()
+    assert Blob.by_id(blob._id) is None
+    assert not os.path.exists(local_path)
@@ -0,0 +1,109 @@
+from botocore.client import ClientError
+import io
+import pytest
+import threading
+from unittest import mock
+
+from backends.s3 import S3Backend
+from tests import *
+
+
+class StubS3Client:
+    """
+    A stub for the S3 client that records multipart uploads. Uploading a part
+    can be made to fail a number of times, and parts can be made to wait for
+    the part after them to be uploaded first.
+    """
+
+    def __init__(self, failures=None, reverse=False):
+        self.failures = failures or {}
+        self.reverse = reverse
+        self.parts = {}
+        self.completed = None
+        self.aborted = False
+        self._uploaded = {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted = True
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.completed = MultipartUpload['Parts']
+
+    def create_multipart_upload(self, Bucket, Key, **options):
+        return {'UploadId': 'test'}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        if self.failures.get(PartNumber):
+            self.failures[PartNumber] -= 1
+            raise ClientError(
+                {'Error': {'Code': '500', 'Message': 'Internal error'}},
+                'UploadPart'
+                )
+
+        # Wait for the next part to be uploaded first
+        if self.reverse and PartNumber % 2:
+            self._get_event(PartNumber + 1).wait(5)
+
+        self.parts[PartNumber] = Body
+        self._get_event(PartNumber).set()
+        return {'ETag': '"etag-{0}"'.format(PartNumber)}
+
+    def _get_event(self, part_number):
+        return self._uploaded.setdefault(part_number, threading.Event())
+
+
+@pytest.yield_fixture
+def s3_backend(app):
+    """Return an S3 backend that uses a stub client and small parts"""
+    config = app.config
+    settings = {
+        'S3_MULTIPART_THRESHOLD': 8,
+        'S3_MULTIPART_PART_SIZE': 4,
+        'S3_MULTIPART_CONCURRENCY': 2,
+        'S3_MULTIPART_RETRIES': 2
+        }
+    original_settings = {k: config[k] for k in settings}
+    config.update(settings)
+
+    backend = S3Backend(access_key='test', secret_key='test', bucket='test')
+    yield backend
+
+    config.update(original_settings)
+
+def test_store_multipart(s3_backend):
+    # Store a file with parts that finish uploading out of order
+    s3_backend.client = client = StubS3Client(reverse=True)
+    data = b'abcdefghijklmnopqrstu'
+    s3_backend.store(io.BytesIO(data), 'test.txt')
+
+    # Check the upload was completed with the parts in order
+    assert client.completed == [
+        {'ETag': '"etag-{0}"'.format(n), 'PartNumber': n}
+        for n in range(1, 7)
+        ]
+    assert b''.join(client.parts[n] for n in range(1, 7)) == data
+    assert not client.aborted
+
+def test_store_multipart_retry(s3_backend):
+    # Store a file with a part that fails to upload twice
+    s3_backend.client = client = StubS3Client(failures={2: 2})
+    with mock.patch('backends.s3.time') as s3_time:
+        s3_backend.store(io.BytesIO(b'abcdefghijkl'), 'test.txt')
+
+    # Check the part was retried (backing off between each attempt)
+    assert client.parts[2] == b'efgh'
+    assert [c[0][0] for c in s3_time.sleep.call_args_list] == [0.5, 1.0]
+    assert len(client.completed) == 3
+    assert not client.aborted
+
+def test_store_multipart_abort(s3_backend):
+    # Store a file with a part that fails to upload more times than it's
+    # retried.
+    s3_backend.client = client = StubS3Client(failures={2: 3})
+    with mock.patch('backends.s3.time'):
+        with pytest.raises(ClientError):
+            s3_backend.store(io.BytesIO(b'abcdefghijkl'), 'test.txt')
+
+    # Check the upload was aborted
+    assert client.completed is None
+    assert client.aborted
@@ -10,7 +10,9 @@ def test_init(app):
     # Check the correct list of collections has been initialized
     expected_collection = {
         'Account',
-        'Asset'
+        'Asset',
+        'Blob',
+        'Upload'
         }
     assert set(current_app.db.collection_names(False)) == expected_collection
 
@@ -0,0 +1,42 @@
+from mongoframes import *
+
+from models.accounts import Account
+from tests import *
+
+
+def test_get_backend_instance(app, test_local_account):
+    account = test_local_account
+
+    # Check the backend instance is reused for the account
+    backend = account.get_backend_instance()
+    assert account.get_backend_instance() is backend
+    assert Account.by_id(account._id).get_backend_instance() is backend
+
+    # Check a new instance is created if the backend configuration changes
+    account.backend['asset_root'] = 'tests/data'
+    assert account.get_backend_instance() is not backend
+
+    # Check updating the account clears the cached instance
+    backend = account.get_backend_instance()
+    account.update('modified', 'backend')
+    assert account.get_backend_instance() is not backend
+
+def test_by_api_key(app, test_local_account):
+    account = test_local_account
+    cache = app.account_cache
+
+    # Check the account is found and then cached
+    misses = cache.misses
+    assert Account.by_api_key(account.api_key)._id == account._id
+    assert cache.misses == misses + 1
+
+    hits = cache.hits
+    assert Account.by_api_key(account.api_key)._id == account._id
+    assert cache.hits == hits + 1
+
+    # Check the cache is cleared when the API key is changed
+    old_api_key = account.api_key
+    account.api_key = account.generate_api_key()
+    account.update('modified', 'api_key')
+    assert Account.by_api_key(old_api_key) is None
+    assert Account.by_api_key(account.api_key)._id == account._id
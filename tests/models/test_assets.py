@@ -0,0 +1,294 @@
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageChops, ImageDraw, ImageStat
+import io
+import random
+import threading
+from unittest import mock
+
+from models.assets import Variation
+from tests import *
+
+
+def test_transform_images():
+    # Use a smooth gradient so images resized from a different source can be
+    # compared.
+    im = Image.linear_gradient('L').resize((1200, 900)).convert('RGB')
+
+    # Define a set of variations which share common ops
+    variations = {
+        'large': [['fit', [400, 400]], ['output', {'format': 'png'}]],
+        'small': [['fit', [200, 200]], ['output', {'format': 'jpg'}]],
+        'crop_small': [
+            ['crop', [0, 0.5, 0.5, 0]],
+            ['fit', [100, 100]],
+            ['output', {'format': 'webp'}]
+            ],
+        'crop_rotate': [
+            ['crop', [0, 0.5, 0.5, 0]],
+            ['fit', [50, 80]],
+            ['rotate', 90]
+            ]
+        }
+
+    # Transform the images for the variations in turn and concurrently
+    # (recording the threads each branch of operations is transformed in).
+    threads = set()
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+
+        def submit(fn, *args):
+            def call():
+                threads.add(threading.current_thread())
+                return fn(*args)
+            return executor.submit(call)
+
+        for transformed in [
+                list(Variation.transform_images(im, variations)),
+                list(Variation.transform_images(im, variations, submit=submit))
+                ]:
+
+            # Check each variation matches the variation produced when
+            # transforming the image on its own.
+            assert len(transformed) == len(variations)
+
+            for name, vim, fmt in transformed:
+                expected_im, expected_fmt = \
+                        Variation.transform_image(im, variations[name])
+
+                assert fmt == expected_fmt
+                assert vim.mode == expected_im.mode
+                assert vim.size == expected_im.size
+
+                diff = ImageChops.difference(
+                    vim.convert('RGB'),
+                    expected_im.convert('RGB')
+                    )
+                assert max(ImageStat.Stat(diff).mean) < 2
+
+    # Check the branches were transformed by the executor's threads
+    assert threads
+    assert threading.current_thread() not in threads
+
+def test_get_source_size():
+    size = (6000, 4000)
+
+    # Fits determine the size of the image required
+    ops = [['fit', [200, 200]]]
+    assert Variation.get_source_size(size, ops) == (200, 134)
+
+    # Crops increase the size of the image required (allowing for rotation)
+    ops = [
+        ['crop', [0, 0.5, 0.5, 0]],
+        ['rotate', 90],
+        ['fit', [200, 300]]
+        ]
+    assert Variation.get_source_size(size, ops) == (600, 400)
+
+    # Without a fit (or with a face op) the full size image is required
+    assert Variation.get_source_size(size, [['rotate', 90]]) == size
+    ops = [['face', {}], ['fit', [200, 200]]]
+    assert Variation.get_source_size(size, ops) == size
+
+def test_transform_images_draft():
+    # Compare images transformed from a JPEG decoded at a reduced scale against
+    # images transformed from the full size JPEG for random op lists.
+    r = random.Random(51)
+
+    f = io.BytesIO()
+    im = Image.linear_gradient('L').resize((1200, 900)).convert('RGB')
+    im.save(f, format='jpeg', quality=95)
+
+    def random_op():
+        op_type = r.choice(['crop', 'fit', 'rotate'])
+
+        if op_type == 'crop':
+            top, bottom = sorted([r.uniform(0, 0.45), r.uniform(0.55, 1)])
+            left, right = sorted([r.uniform(0, 0.45), r.uniform(0.55, 1)])
+            return ['crop', [top, right, bottom, left]]
+
+        elif op_type == 'fit':
+            return ['fit', [r.randint(10, 300), r.randint(10, 300)]]
+
+        return ['rotate', r.choice([0, 90, 180, 270])]
+
+    drafted = 0
+    for i in range(300):
+        ops = [random_op() for j in range(r.randint(1, 4))]
+        ops.append(['fit', [r.randint(10, 300), r.randint(10, 300)]])
+
+        # Transform the full size image
+        f.seek(0)
+        expected_im, fmt = Variation.transform_image(Image.open(f), ops)
+
+        # Transform the image decoded at the smallest scale allowed
+        f.seek(0)
+        im = Image.open(f)
+        size = im.size
+        im.draft(im.mode, Variation.get_source_size(size, ops))
+        if im.size != size:
+            drafted += 1
+
+        name, vim, fmt = \
+                next(Variation.transform_images(im, {'test': ops}, size=size))
+
+        # Check the variations are the same size (and look the same)
+        assert vim.size == expected_im.size
+
+        diff = ImageChops.difference(vim, expected_im)
+        assert max(ImageStat.Stat(diff).mean) < 4
+
+    # Check most of the images were decoded at a reduced scale
+    assert drafted > 200
+
+def test_detect_faces(app):
+
+    class StubFaceDetectionPool:
+        """A face detection pool that finds the same face in every image"""
+
+        def __init__(self, face):
+            self.face = face
+            self.images = []
+
+        def detect(self, im):
+            self.images.append(im)
+            return [self.face]
+
+    im = Image.new('RGB', (3000, 2000))
+
+    # Check faces are detected in a greyscale copy of the image scaled to fit
+    # the detection size, and the faces found are scaled to the image's size.
+    face_pool = StubFaceDetectionPool((100, 50, 199, 149))
+    with mock.patch.object(app, 'face_pool', face_pool):
+        faces = Variation.detect_faces(im)
+
+    assert len(face_pool.images) == 1
+    assert face_pool.images[0].mode == 'L'
+    assert max(face_pool.images[0].size) == app.config['FACE_DETECTION_SIZE']
+    assert len(faces) == 1
+    assert all(abs(a - b) <= 3 for a, b in zip(faces[0], [300, 150, 600, 450]))
+
+    # Check faces already detected are used to find a face
+    with mock.patch.object(app, 'face_pool', face_pool):
+        rect = Variation.find_face(im, padding=0.5, faces=faces)
+
+    assert len(face_pool.images) == 1
+    assert all(abs(a - b) <= 3 for a, b in zip(rect, [150, 0, 750, 600]))
+
+    # Check faces are kept within the image
+    face_pool = StubFaceDetectionPool((-10, -10, 999, 999))
+    with mock.patch.object(app, 'face_pool', face_pool):
+        assert Variation.detect_faces(im) == [[0, 0, 3000, 2000]]
+
+def test_map_faces():
+    # Draw a "face" on an image so we can find where it ends up
+    im = Image.new('L', (400, 300))
+    ImageDraw.Draw(im).rectangle([100, 60, 179, 119], fill=255)
+    faces = [[0.25, 0.2, 0.45, 0.4]]
+
+    # Check the faces are mapped to the same region the face is moved to by
+    # each operation.
+    ops = [
+        ['crop', [0.1, 0.9, 0.9, 0.2]],
+        ['rotate', 90],
+        ['fit', [100, 100]],
+        ['rotate', 180],
+        ['rotate', 270],
+        ['box', [50, 40, 90, 80]]
+        ]
+    for op in ops:
+        faces = Variation.map_faces(faces, op, im)
+        im = Variation.apply_op(im, op)
+
+        rect = Variation.get_face_rects(faces, im.size)[0]
+        bbox = im.point(lambda p: 255 if p > 128 else 0).getbbox()
+        assert all(abs(a - b) <= 1 for a, b in zip(rect, bbox))
+
+    # Check faces outside a cropped region are removed
+    assert Variation.map_faces(faces, ['box', [0, 0, 1, 1]], im) == []
+
+def test_get_ops_hash():
+    ops = [
+        ['output', {'format': 'png'}],
+        ['crop', [0, 1, 1, 0.5]],
+        ['rotate', 0],
+        ['face', {'padding': 0, 'bias': [0, 0]}],
+        ['fit', [100, 100]]
+        ]
+
+    # Check ops that produce the same variation produce the same hash
+    assert Variation.get_ops_hash(ops) == Variation.get_ops_hash([
+        ['crop', [0.0, 1.0, 1.0, 0.5]],
+        ['face', {}],
+        ['fit', [100, 100]],
+        ['output', {'format': 'png'}]
+        ])
+
+    # Check ops that produce a different variation produce a different hash
+    assert Variation.get_ops_hash(ops) != Variation.get_ops_hash([
+        ['crop', [0, 1, 1, 0.5]],
+        ['face', {'padding': 0.1}],
+        ['fit', [100, 100]],
+        ['output', {'format': 'png'}]
+        ])
+
+def test_optimize_ops():
+    # Compare images transformed using optimized ops against images transformed
+    # by performing each op in turn for a large number of random op lists.
+    r = random.Random(51)
+
+    def random_op():
+        op_type = r.choice(['crop', 'fit', 'rotate'])
+
+        if op_type == 'crop':
+            top, bottom = sorted([r.uniform(0, 1), r.uniform(0, 1)])
+            left, right = sorted([r.uniform(0, 1), r.uniform(0, 1)])
+            return ['crop', [top, right, bottom, left]]
+
+        elif op_type == 'fit':
+            return ['fit', [r.randint(20, 600), r.randint(20, 600)]]
+
+        return ['rotate', r.choice([0, 90, 180, 270])]
+
+    for i in range(500):
+        ops = [random_op() for j in range(r.randint(1, 6))]
+        size = (r.randint(50, 900), r.randint(50, 900))
+
+        # Small images are more likely to be cropped away to nothing
+        if i % 6 == 0:
+            size = (r.randint(1, 20), r.randint(1, 20))
+        has_fit = [op for op in ops if op[0] == 'fit']
+
+        # Without fits the images must match exactly so we use noise, with fits
+        # the images are resampled differently so we use a smooth gradient.
+        if has_fit:
+            im = Image.linear_gradient('L').resize(size).convert('RGB')
+        else:
+            im = Image.effect_noise(size, 64).convert('RGB')
+
+        # Perform each op in turn
+        expected_im = im
+        for op in ops:
+            expected_im = Variation.apply_op(expected_im, op)
+
+        # Perform the optimized ops
+        optimized_ops = Variation.optimize_ops(ops, size)
+
+        optimized_im = im
+        for op in optimized_ops:
+            optimized_im = Variation.apply_op(optimized_im, op)
+
+        # Compare the images (op lists that crop the image away to nothing are
+        # performed as given).
+        assert optimized_im.size == expected_im.size
+        if 0 in expected_im.size:
+            assert optimized_ops == ops
+            continue
+
+        assert len(optimized_ops) <= 3
+
+        diff = ImageChops.difference(optimized_im, expected_im)
+        diff = max(ImageStat.Stat(diff).mean)
+        if has_fit:
+            assert diff < 4
+        else:
+            assert diff == 0
@@ -0,0 +1,54 @@
+import io
+from mongoframes import *
+import os
+from pymongo.collection import Collection
+from pymongo.errors import DuplicateKeyError
+from unittest import mock
+
+from models.blobs import Blob
+from tests import *
+
+
+def test_store_concurrent(app, test_local_account):
+    account = test_local_account
+    backend = account.get_backend_instance()
+
+    # Store a blob
+    blob = Blob.store(account, 'test', io.BytesIO(b'test'), 'txt')
+
+    # Store the same file again as if the blob was added by another process
+    # while our file was being stored (the check for an existing blob misses
+    # it and our upsert fails against the unique index).
+    acquire = Blob.acquire
+    acquire_results = [None]
+
+    def _acquire(account, hash):
+        if acquire_results:
+            return acquire_results.pop()
+        return acquire(account, hash)
+
+    find_one_and_update = Collection.find_one_and_update
+
+    def _find_one_and_update(self, *args, **kwargs):
+        if kwargs.get('upsert'):
+            raise DuplicateKeyError('Duplicate key')
+        return find_one_and_update(self, *args, **kwargs)
+
+    with mock.patch.object(Blob, 'acquire', side_effect=_acquire), \
+            mock.patch.object(
+                Collection,
+                'find_one_and_update',
+                _find_one_and_update
+                ):
+        other_blob = Blob.store(account, 'test', io.BytesIO(b'test'), 'txt')
+
+    # Check the existing blob is referenced and our file was removed
+    assert other_blob._id == blob._id
+    assert Blob.by_id(blob._id).refs == 2
+    assert os.listdir(backend.get_local_path('blobs')) == \
+            [os.path.basename(blob.store_key)]
+
+    # Release the blob
+    Blob.release(account, blob.store_key)
+    Blob.release(account, blob.store_key)
+    assert Blob.by_id(blob._id) is None
\ No newline at end of file
@@ -1,12 +1,31 @@
 from datetime import datetime, timedelta, timezone
+import io
 from mongoframes import *
 import time
+from unittest import mock
 
-from models.accounts import Account
 from models.assets import Asset
+from models.uploads import Upload
 from tests import *
+from utils.faces import FaceDetectionPoolBusy
 
 
+def test_detect_faces_busy(celery_app, test_images):
+    asset = test_images[0]
+
+    # Call the `detect_faces` task while face detection is busy
+    with mock.patch.object(
+                Asset,
+                'detect_faces',
+                side_effect=[FaceDetectionPoolBusy('Timed out'), None]
+                ) as detect_faces:
+        task = celery_app.tasks['detect_faces']
+        result = task.apply([asset.account, asset.uid])
+
+    # Check the task was retried
+    assert result.successful()
+    assert detect_faces.call_count == 2
+
 def test_generate_varations(celery_app, test_images):
     asset = test_images[0]
 
@@ -38,9 +57,31 @@ def test_generate_varations(celery_app, test_images):
     assert variation['store_key'] == key
     assert variation['meta']['image'] == {
         'mode': 'RGB',
-        'size': [200, 150]
+        'size': [100, 75]
         }
 
+def test_prep_asset(celery_app, test_local_assets):
+    asset = Asset.one(Q.name == 'file')
+    meta = asset.meta
+
+    # Flag the asset as waiting to be prepared (as for a file uploaded
+    # directly to the backend).
+    asset.meta = {
+        'filename': meta['filename'],
+        'length': meta['length'],
+        'pending': True
+        }
+    asset.update('modified', 'meta')
+
+    # Call the `prep_asset` task
+    task = celery_app.tasks['prep_asset']
+    task.apply([asset.account, asset.uid])
+
+    # Check the asset was prepared
+    asset.reload()
+    assert asset.meta['hash'] == meta['hash']
+    assert 'pending' not in asset.meta
+
 def test_purge_expired_assets(celery_app, test_images):
     # Set the expiry date for all assets to an hour ago
     expires = datetime.now(timezone.utc) - timedelta(seconds=3600)
@@ -56,3 +97,30 @@ def test_purge_expired_assets(celery_app, test_images):
 
     # Check all the assets where purged
     assert Asset.count() == 0
+
+
+def test_purge_expired_uploads(celery_app, test_backends):
+    account = test_backends[0]
+    backend = account.get_backend_instance()
+
+    # Reserve an upload that expired an hour ago and upload a file for it
+    expires = datetime.now(timezone.utc) - timedelta(seconds=3600)
+    upload = Upload(
+        account=account._id,
+        uid='test',
+        name='file',
+        ext='txt',
+        filename='file.txt',
+        store_key='file.test.txt',
+        expires=time.mktime(expires.timetuple())
+        )
+    upload.insert()
+    backend.store(io.BytesIO(b'test'), upload.store_key)
+
+    # Call the `purge_expired_uploads` task
+    task = celery_app.tasks['purge_expired_uploads']
+    task.apply()
+
+    # Check the upload and its file were purged
+    assert Upload.count() == 0
+    assert backend.get_length(upload.store_key) is None
\ No newline at end of file
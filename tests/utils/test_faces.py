@@ -0,0 +1,121 @@
+from PIL import Image
+import os
+import pytest
+import time
+
+from utils import faces
+from utils.faces import FaceDetectionPool, FaceDetectionPoolBusy
+
+# The value of an image's first pixel determines how the stub face detector
+# behaves.
+FIND_FACE = 0
+SLOW = 1
+ERROR = 2
+CRASH = 3
+
+
+class StubRect:
+    """A stub for a face rectangle found by the face detector"""
+
+    def __init__(self, left, top, right, bottom):
+        self._rect = (left, top, right, bottom)
+
+    def left(self):
+        return self._rect[0]
+
+    def top(self):
+        return self._rect[1]
+
+    def right(self):
+        return self._rect[2]
+
+    def bottom(self):
+        return self._rect[3]
+
+
+class StubFaceDetectionPool(FaceDetectionPool):
+    """A face detection pool that uses a stub face detector"""
+
+    def _create_pool(self, context):
+        return context.Pool(
+            self.processes,
+            initializer=_init_stub_process,
+            initargs=(self._slots, self._slot_pids, self.upsample)
+            )
+
+
+def _init_stub_process(slots, slot_pids, upsample):
+    faces._detector = _stub_detector
+    faces._slots = slots
+    faces._slot_pids = slot_pids
+    faces._upsample = upsample
+
+def _stub_detector(im, upsample):
+    behaviour = im[0, 0]
+
+    if behaviour == SLOW:
+        time.sleep(2)
+
+    elif behaviour == ERROR:
+        raise ValueError('Detection failed')
+
+    elif behaviour == CRASH:
+        os._exit(1)
+
+    h, w = im.shape
+    return [StubRect(0, 0, w, h)]
+
+def make_image(behaviour, size=(8, 6)):
+    """Return an image that triggers the given stub detector behaviour"""
+    im = Image.new('L', size, 255)
+    im.putpixel((0, 0), behaviour)
+    return im
+
+@pytest.yield_fixture
+def face_pool():
+    """Return a stub face detection pool with a single slot"""
+    pool = StubFaceDetectionPool(1, 1, 16, 0, 1)
+    yield pool
+    pool.close()
+
+def test_detect(face_pool):
+    # Check the pool can be started ahead of detecting faces
+    face_pool.start()
+
+    # Check faces are detected and the slot is reused
+    for size in [(8, 6), (16, 16), (4, 2)]:
+        w, h = size
+        assert face_pool.detect(make_image(FIND_FACE, size)) == [(0, 0, w, h)]
+
+    # Check images must fit the slots
+    with pytest.raises(ValueError):
+        face_pool.detect(make_image(FIND_FACE, (17, 16)))
+
+def test_detect_busy(face_pool):
+    # Check callers are told the pool is busy if detection takes too long
+    with pytest.raises(FaceDetectionPoolBusy):
+        face_pool.detect(make_image(SLOW))
+
+    # Check callers are told the pool is busy while there are no free slots
+    with pytest.raises(FaceDetectionPoolBusy):
+        face_pool.detect(make_image(FIND_FACE))
+
+    # Check the slot is freed once the slow detection finishes
+    time.sleep(1)
+    assert face_pool.detect(make_image(FIND_FACE)) == [(0, 0, 8, 6)]
+
+def test_detect_error(face_pool):
+    # Check errors are raised to the caller
+    with pytest.raises(ValueError):
+        face_pool.detect(make_image(ERROR))
+
+    # Check the slot is freed
+    assert face_pool.detect(make_image(FIND_FACE)) == [(0, 0, 8, 6)]
+
+def test_detect_crash(face_pool):
+    # Check callers are told the pool is busy if the process dies
+    with pytest.raises(FaceDetectionPoolBusy):
+        face_pool.detect(make_image(CRASH))
+
+    # Check the slot is reclaimed (the pool replaces the process)
+    assert face_pool.detect(make_image(FIND_FACE)) == [(0, 0, 8, 6)]
\ No newline at end of file
@@ -0,0 +1,70 @@
+from PIL import Image, ImageChops
+import io
+import pytest
+import shutil
+import struct
+
+from utils import jpeg
+
+
+def make_jpeg(size, orientation=None):
+    """Return the data for a JPEG holding EXIF data and a comment"""
+    w, h = size
+    im = Image.frombytes(
+        'L',
+        size,
+        bytes((x * 255 // w) for y in range(h) for x in range(w))
+        )
+
+    f = io.BytesIO()
+    im.convert('RGB').save(f, format='jpeg')
+    data = f.getvalue()
+
+    # Build the EXIF (APP1) and comment (COM) segments by hand
+    exif = b'Exif\x00\x00II*\x00' + struct.pack('<IH', 8, 1)
+    exif += struct.pack('<HHIHHI', 0x0112, 3, 1, orientation or 1, 0, 0)
+    comment = b'hangar51'
+
+    return b''.join([
+        data[:2],
+        b'\xff\xe1' + struct.pack('>H', len(exif) + 2) + exif,
+        b'\xff\xfe' + struct.pack('>H', len(comment) + 2) + comment,
+        data[2:]
+        ])
+
+def test_strip_meta():
+    data = make_jpeg((64, 48))
+    stripped = jpeg.strip_meta(data)
+
+    # Check the meta data has been removed
+    im = Image.open(io.BytesIO(stripped))
+    assert [m for m, d in im.applist] == ['APP0']
+    assert 'exif' not in im.info
+
+    # Check the image is unchanged
+    original_im = Image.open(io.BytesIO(data))
+    assert ImageChops.difference(im, original_im).getbbox() is None
+
+    # Check truncated files are rejected
+    with pytest.raises(ValueError):
+        jpeg.strip_meta(data[:5])
+
+    with pytest.raises(ValueError):
+        jpeg.strip_meta(data[:20])
+
+@pytest.mark.skipif(not shutil.which('jpegtran'), reason='requires jpegtran')
+def test_orient():
+    data = make_jpeg((64, 48), 6)
+    oriented = jpeg.orient(data, 6)
+
+    # Check the image has been oriented and the meta data removed
+    im = Image.open(io.BytesIO(oriented))
+    assert im.size == (48, 64)
+    assert 'exif' not in im.info
+
+    # Check the image is oriented losslessly
+    expected_im = Image.open(io.BytesIO(data)).transpose(Image.ROTATE_270)
+    assert ImageChops.difference(im, expected_im).getbbox() is None
+
+    # Check images that can't be oriented losslessly are rejected
+    assert jpeg.orient(make_jpeg((65, 49), 6), 6) is None
\ No newline at end of file
@@ -0,0 +1,31 @@
+import hashlib
+
+from utils import get_file_hash, get_file_length
+from utils.uploads import UploadFile
+
+
+def test_upload_file():
+    data = b'hangar51' * 1000
+
+    # Write a file larger than the spool size in chunks
+    f = UploadFile(1024)
+    for i in range(0, len(data), 500):
+        f.write(data[i:i + 500])
+
+        # Check the file is held in memory (and so has no name) until it grows
+        # larger than the spool size.
+        if i + 500 <= 1024:
+            assert getattr(f, 'name', None) is None
+
+    # Check the file was spooled to disk, measured and hashed as it was written
+    assert getattr(f, 'name', None) is not None
+    assert get_file_length(f) == len(data)
+    assert get_file_hash(f) == hashlib.sha256(data).hexdigest()
+
+    # Check the file is rewound when it's measured or hashed (as for any
+    # other file) so it can be read (again) in full.
+    assert f.read() == data
+    assert get_file_length(f) == len(data)
+    assert f.read() == data
+    assert get_file_hash(f) == hashlib.sha256(data).hexdigest()
+    assert f.read() == data
\ No newline at end of file
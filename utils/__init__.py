@@ -2,17 +2,42 @@
 Useful functions used across more than one module.
 """
 
+import hashlib
 import os
 import shortuuid
 
+from utils.uploads import UploadFile
+
 __all__ = [
+    'get_file_hash',
     'get_file_length',
     'generate_uid'
     ]
 
 
+def get_file_hash(f):
+    """Return a (SHA-256) hash of the contents of a file storage object"""
+
+    # Uploaded files are hashed as they're received
+    if isinstance(f, UploadFile):
+        f.seek(0)
+        return f.hexdigest()
+
+    file_hash = hashlib.sha256()
+    f.seek(0)
+    for chunk in iter(lambda: f.read(64 * 1024), b''):
+        file_hash.update(chunk)
+    f.seek(0)
+    return file_hash.hexdigest()
+
 def get_file_length(f):
     """Return the length of a file storage object"""
+
+    # Uploaded files are measured as they're received
+    if isinstance(f, UploadFile):
+        f.seek(0)
+        return f.length
+
     f.seek(0, os.SEEK_END)
     length = f.tell()
     f.seek(0)
@@ -0,0 +1,88 @@
+"""
+A simple in-process cache for use across threads.
+"""
+
+from collections import OrderedDict
+import threading
+import time
+
+__all__ = ['LRUCache']
+
+
+class LRUCache:
+    """
+    A thread-safe, size bounded cache. Once the cache holds `max_size` items,
+    setting a new item evicts the least recently used item. Optionally items
+    can be set to expire `ttl` seconds after they're added, for example:
+
+    ```
+    cache = LRUCache(100, ttl=60)
+    cache.set('foo', 'bar')
+    cache.get('foo')
+    ```
+
+    The number of cache hits and misses is recorded against the cache (`hits`
+    and `misses`).
+    """
+
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+    # Methods
+
+    def clear(self):
+        """Remove all items from the cache"""
+        with self._lock:
+            self._items.clear()
+
+    def delete(self, key):
+        """Remove an item from the cache (if present)"""
+        with self._lock:
+            self._items.pop(key, None)
+
+    def get(self, key, default=None):
+        """Return an item from the cache or `default` if it's not present"""
+        with self._lock:
+            if key not in self._items:
+                self.misses += 1
+                return default
+
+            # Check the item hasn't expired
+            value, expires = self._items[key]
+            if expires is not None and expires <= time.time():
+                del self._items[key]
+                self.misses += 1
+                return default
+
+            # Mark the item as the most recently used
+            self._items.move_to_end(key)
+            self.hits += 1
+
+            return value
+
+    def set(self, key, value):
+        """Add an item to the cache"""
+        expires = None
+        if self.ttl is not None:
+            expires = time.time() + self.ttl
+
+        with self._lock:
+            self._items[key] = (value, expires)
+            self._items.move_to_end(key)
+
+            # Evict the least recently used items if the cache is full
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
@@ -0,0 +1,207 @@
+"""
+A pool of processes for detecting faces in images.
+
+Face detection is CPU bound and holds the GIL, running it in a separate pool of
+processes (each with the face detector already loaded) leaves the application's
+processes free to handle other requests.
+"""
+
+import multiprocessing
+import os
+import queue
+import threading
+
+import numpy
+
+__all__ = [
+    'FaceDetectionPool',
+    'FaceDetectionPoolBusy'
+    ]
+
+
+class FaceDetectionPoolBusy(Exception):
+    """
+    Raised when the face detection pool can't detect faces within the pool's
+    timeout.
+    """
+
+
+class FaceDetectionPool:
+    """
+    A pool of processes that detect faces in greyscale images.
+
+    Images are passed to the processes through a fixed number of shared memory
+    slots (each large enough to hold a `max_size` x `max_size` image). The
+    number of slots bounds the number of images queued for the pool, once all
+    the slots are in use callers wait (up to `timeout` seconds) for a slot to
+    be freed.
+
+    The pool's processes are started by calling `start` (the application
+    starts them once it's serving requests or running tasks, see `create_app`)
+    or otherwise the first time faces are detected, so processes that never
+    detect faces (e.g. management commands) don't start them. Processes are
+    started using a fork server (rather than forked from the caller) as the
+    caller may hold connections (e.g. to mongo) that aren't safe to fork.
+    """
+
+    def __init__(self, processes, queue_size, max_size, upsample, timeout):
+        self.processes = processes
+        self.queue_size = queue_size
+        self.max_size = max_size
+        self.upsample = upsample
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._pool = None
+
+        # Slots held by detections the caller gave up waiting for
+        self._abandoned = {}
+
+    def close(self):
+        """Stop the pool's processes"""
+        with self._lock:
+            if self._pool:
+                self._pool.terminate()
+                self._pool.join()
+                self._pool = None
+
+    def start(self):
+        """Start the pool's processes (if they haven't been started)"""
+        self._get_pool()
+
+    def detect(self, im):
+        """
+        Detect faces in a greyscale (`L` mode) image and return their
+        rectangles as a list of `(left, top, right, bottom)` values.
+        """
+        w, h = im.size
+        if im.mode != 'L' or w > self.max_size or h > self.max_size:
+            raise ValueError(
+                'Images must be greyscale and fit within {0}x{0} pixels'.format(
+                    self.max_size
+                    )
+                )
+
+        pool = self._get_pool()
+
+        # Wait for a free slot
+        self._reclaim_slots()
+        try:
+            slot = self._free_slots.get(timeout=self.timeout)
+        except queue.Empty:
+            raise FaceDetectionPoolBusy('No free slots')
+
+        # Copy the image into the slot and detect the faces, the slot is freed
+        # once the process has finished with it (even if the caller gives up
+        # waiting).
+        try:
+            self._slot_pids[slot] = 0
+            memoryview(self._slots[slot]).cast('B')[:w * h] = im.tobytes()
+            result = pool.apply_async(
+                _detect,
+                (slot, w, h),
+                callback=lambda r: self._free_slots.put(slot),
+                error_callback=lambda e: self._free_slots.put(slot)
+                )
+        except Exception:
+            self._free_slots.put(slot)
+            raise
+
+        try:
+            return result.get(self.timeout)
+        except multiprocessing.TimeoutError:
+            with self._lock:
+                self._abandoned[slot] = result
+            raise FaceDetectionPoolBusy('Timed out')
+
+    def _create_pool(self, context):
+        """Return a new pool of processes"""
+        return context.Pool(
+            self.processes,
+            initializer=_init_process,
+            initargs=(self._slots, self._slot_pids, self.upsample)
+            )
+
+    def _get_pool(self):
+        """Return the pool, starting it if it hasn't been started"""
+        with self._lock:
+            if self._pool:
+                return self._pool
+
+            context = multiprocessing.get_context('forkserver')
+
+            # Create the shared memory slots images are passed through, along
+            # with the Id of the process using each slot.
+            self._slots = [
+                context.RawArray('B', self.max_size * self.max_size)
+                for i in range(self.queue_size)
+                ]
+            self._slot_pids = context.RawArray('i', self.queue_size)
+
+            self._free_slots = queue.Queue()
+            for i in range(self.queue_size):
+                self._free_slots.put(i)
+
+            # Start the pool
+            self._pool = self._create_pool(context)
+
+            return self._pool
+
+    def _reclaim_slots(self):
+        """
+        Free the slots held by abandoned detections whose process died. The
+        pool replaces processes that die but the detection is lost and its
+        callbacks are never called, so without this the slot is never freed.
+
+        Each process records its Id against the slot it's using (see
+        `_detect`) so we can check whether the process is still alive.
+        """
+        with self._lock:
+            for slot, result in list(self._abandoned.items()):
+                if result.ready():
+                    # The slot was freed by the detection's callback
+                    del self._abandoned[slot]
+
+                elif self._slot_pids[slot] \
+                        and not _is_alive(self._slot_pids[slot]):
+                    del self._abandoned[slot]
+                    self._free_slots.put(slot)
+
+
+# Utils
+
+def _is_alive(pid):
+    """Return True if the process with the given Id is alive"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+# Pool processes
+
+_detector = None
+_slots = None
+_slot_pids = None
+_upsample = None
+
+def _init_process(slots, slot_pids, upsample):
+    """Load the face detector for the process"""
+    global _detector, _slots, _slot_pids, _upsample
+
+    import dlib
+
+    _detector = dlib.get_frontal_face_detector()
+    _slots = slots
+    _slot_pids = slot_pids
+    _upsample = upsample
+
+def _detect(slot, w, h):
+    """Detect faces in the image held in a slot"""
+    _slot_pids[slot] = os.getpid()
+    im = numpy.frombuffer(_slots[slot], numpy.uint8, count=w * h)
+    faces = _detector(im.reshape(h, w), _upsample)
+    return [(f.left(), f.top(), f.right(), f.bottom()) for f in faces]
\ No newline at end of file
@@ -0,0 +1,127 @@
+"""
+Lossless operations on JPEG files.
+
+JPEGs are transformed in their compressed form (rather than being decoded and
+encoded again) so that the image quality is preserved and the cost is close to
+that of copying the file.
+"""
+
+import shutil
+import struct
+import subprocess
+
+__all__ = [
+    'orient',
+    'strip_meta'
+    ]
+
+
+# The `jpegtran` arguments that orient an image for each EXIF orientation value
+ORIENTATION_ARGS = {
+    2: ['-flip', 'horizontal'],
+    3: ['-rotate', '180'],
+    4: ['-flip', 'vertical'],
+    5: ['-transpose'],
+    6: ['-rotate', '90'],
+    7: ['-transverse'],
+    8: ['-rotate', '270']
+    }
+
+# Markers for segments that have no length/data
+STANDALONE_MARKERS = {0x01} | set(range(0xD0, 0xD8))
+
+
+def orient(data, orientation):
+    """
+    Return the data for a JPEG oriented according to the given EXIF orientation
+    value and stripped of meta data, or None if the JPEG cannot be oriented
+    losslessly.
+
+    The transform is applied to the image's DCT coefficients using `jpegtran`,
+    images with dimensions that aren't a multiple of the MCU size (or where
+    `jpegtran` isn't installed) can't be transformed losslessly.
+    """
+    jpegtran = shutil.which('jpegtran')
+    if not jpegtran or orientation not in ORIENTATION_ARGS:
+        return None
+
+    args = [jpegtran, '-copy', 'none', '-perfect', '-optimize']
+    args += ORIENTATION_ARGS[orientation]
+
+    try:
+        result = subprocess.run(
+            args,
+            input=data,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            timeout=60
+            )
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+    if result.returncode != 0 or not result.stdout:
+        return None
+
+    return result.stdout
+
+def strip_meta(data):
+    """
+    Return the data for a JPEG without any meta data (EXIF, XMP, ICC profiles,
+    comments, thumbnails, etc.). The JFIF and Adobe headers (required to decode
+    the image correctly) are kept.
+    """
+    if data[:2] != b'\xff\xd8':
+        raise ValueError('Not a JPEG')
+
+    stripped = [data[:2]]
+    i = 2
+    while i < len(data):
+        if data[i] != 0xFF:
+            raise ValueError('Invalid JPEG marker at {0}'.format(i))
+
+        # Skip any fill bytes before the marker
+        marker = data[i + 1]
+        if marker == 0xFF:
+            i += 1
+            continue
+
+        # Segments without any data
+        if marker in STANDALONE_MARKERS:
+            stripped.append(data[i:i + 2])
+            i += 2
+            continue
+
+        # End of image, or start of scan after which the entropy coded data
+        # (and any remaining segments) are copied as is.
+        if marker in (0xD9, 0xDA):
+            stripped.append(data[i:])
+            break
+
+        # Segments with data (the length includes the length bytes)
+        if i + 4 > len(data):
+            raise ValueError('Truncated JPEG')
+
+        length = struct.unpack('>H', data[i + 2:i + 4])[0]
+        if i + 2 + length > len(data):
+            raise ValueError('Truncated JPEG')
+
+        segment = data[i:i + 2 + length]
+        payload = segment[4:]
+
+        if marker == 0xFE:
+            # COM
+            pass
+
+        elif 0xE0 <= marker <= 0xEF:
+            # APPn, keep the JFIF (APP0) and Adobe (APP14) headers
+            if marker == 0xE0 and payload.startswith(b'JFIF\x00'):
+                stripped.append(segment)
+            elif marker == 0xEE and payload.startswith(b'Adobe'):
+                stripped.append(segment)
+
+        else:
+            stripped.append(segment)
+
+        i += 2 + length
+
+    return b''.join(stripped)
\ No newline at end of file
@@ -0,0 +1,52 @@
+"""
+Support for receiving uploaded files with bounded memory.
+"""
+
+from flask import current_app, Request
+import hashlib
+import tempfile
+
+__all__ = [
+    'UploadFile',
+    'UploadRequest'
+    ]
+
+
+class UploadFile:
+    """
+    A file that an uploaded file is received into. Files are held in memory
+    until they grow larger than `max_size` bytes after which they're spooled
+    to disk, the file's length and (SHA-256) hash are calculated as it's
+    written.
+    """
+
+    def __init__(self, max_size):
+        self.length = 0
+        self._file = tempfile.SpooledTemporaryFile(max_size=max_size)
+        self._hash = hashlib.sha256()
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def __iter__(self):
+        return iter(self._file)
+
+    def hexdigest(self):
+        """Return the hash of the file's contents"""
+        return self._hash.hexdigest()
+
+    def write(self, data):
+        self._hash.update(data)
+        self.length += len(data)
+        return self._file.write(data)
+
+
+class UploadRequest(Request):
+    """
+    A request that receives uploaded files into `UploadFile`s (see the
+    `UPLOAD_SPOOL_SIZE` setting).
+    """
+
+    def _get_file_stream(self, total_content_length, content_type,
+            filename=None, content_length=None):
+        return UploadFile(current_app.config['UPLOAD_SPOOL_SIZE'])
\ No newline at end of file